@@ -0,0 +1,250 @@
+"""
+Vectorized analytics across many sessions.
+
+`Telemetry.load` reads sessions into dense arrays:
+
+- `data`: `(session, year, metric)`, for the metrics in `METRICS`
+- `mix`: `(session, year, process)`, each process' mix share
+
+Years a session didn't reach are `nan`; years it skipped over
+are filled in from the previous snapshot.
+
+Loaded arrays are cached on disk (by default in `analytics.npz`)
+and only new or changed sessions are read on later loads, e.g.:
+
+    t = Telemetry.load(db)
+    t.median('emissions', by='version')
+    t.fraction_banned('Coal Power Generation', 2040)
+"""
+
+import os
+import json
+import click
+import warnings
+import numpy as np
+from read import gtco2eq
+from partitions import open_database
+
+METRICS = {
+    'emissions': lambda world: gtco2eq(world),
+    'temperature': lambda world: world['temperature'],
+    'outlook': lambda world: world['contentedness'],
+}
+
+FIELDS = ['gameState.world.{}'.format(f) for f in [
+    'year', 'temperature', 'contentedness',
+    'co2_emissions', 'ch4_emissions', 'n2o_emissions',
+]] + ['gameState.processes']
+
+def load_session(db, session_id):
+    """`{year: (metrics, {process: mix_share})}` for one session.
+    If there are several snapshots for a year the last one is used."""
+    years = {}
+    for s in db.iter_snapshots(session_id, fields=FIELDS):
+        state = s['snapshot']['gameState']
+        world = state['world']
+        try:
+            metrics = [fn(world) for fn in METRICS.values()]
+            mix = {p['name']: p['mix_share'] for p in state['processes']}
+        except (KeyError, TypeError):
+            continue
+        years[world['year']] = (metrics, mix)
+    return years
+
+class Telemetry:
+    def __init__(self, sessions, versions, counts, years, processes, data, mix):
+        self.sessions = sessions
+        self.versions = np.array(versions, dtype=object)
+        self.counts = counts
+        self.years = years
+        self.metrics = list(METRICS.keys())
+        self.processes = processes
+        self.data = data
+        self.mix = mix
+
+    @classmethod
+    def load(cls, db, sessions=None, cache='analytics.npz'):
+        """Load `sessions` (as returned by `db.sessions()`; all sessions if `None`).
+        Sessions already in the cache are only re-read if they have new snapshots."""
+        if sessions is None:
+            sessions = db.sessions()
+        sessions = [s for s in sessions if s['n_snapshots'] > 0 and s['first_year'] is not None]
+
+        cached = cls.from_file(cache) if cache and os.path.exists(cache) else None
+        index = {} if cached is None else {id: i for i, id in enumerate(cached.sessions)}
+
+        loaded = {}
+        for s in sessions:
+            i = index.get(s['id'])
+            if i is None or cached.counts[i] != s['n_snapshots']:
+                loaded[s['id']] = load_session(db, s['id'])
+
+        years = [y for s in sessions for y in (s['first_year'], s['last_year'])]
+        years = np.arange(min(years), max(years) + 1) if years else np.arange(0)
+        processes = set() if cached is None else set(cached.processes)
+        for session in loaded.values():
+            for _, mix in session.values():
+                processes.update(mix.keys())
+        processes = sorted(processes)
+
+        data = np.full((len(sessions), len(years), len(METRICS)), np.nan, dtype=np.float32)
+        mix = np.full((len(sessions), len(years), len(processes)), np.nan, dtype=np.float32)
+        for i, s in enumerate(sessions):
+            if s['id'] in loaded:
+                for year, (metrics, shares) in loaded[s['id']].items():
+                    y = year - years[0]
+                    if 0 <= y < len(years):
+                        data[i, y] = metrics
+                        mix[i, y, [processes.index(p) for p in shares]] = list(shares.values())
+                fill_forward(data[i])
+                fill_forward(mix[i])
+            else:
+                # Copy over from the cache, lining up years and processes
+                j = index[s['id']]
+                lo, hi = max(years[0], cached.years[0]), min(years[-1], cached.years[-1]) + 1
+                src = slice(lo - cached.years[0], hi - cached.years[0])
+                dst = slice(lo - years[0], hi - years[0])
+                cols = [processes.index(p) for p in cached.processes]
+                data[i, dst] = cached.data[j, src]
+                mix[i][dst, cols] = cached.mix[j, src]
+
+        t = cls(
+            sessions=[s['id'] for s in sessions],
+            versions=[s['version'] for s in sessions],
+            counts=[s['n_snapshots'] for s in sessions],
+            years=years, processes=processes, data=data, mix=mix)
+        if cache:
+            t.save(cache)
+        return t
+
+    @classmethod
+    def from_file(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            meta = json.loads(str(f['meta']))
+            return cls(
+                sessions=meta['sessions'],
+                versions=meta['versions'],
+                counts=meta['counts'],
+                years=f['years'],
+                processes=meta['processes'],
+                data=f['data'],
+                mix=f['mix'])
+
+    def save(self, path):
+        meta = {
+            'sessions': self.sessions,
+            'versions': list(self.versions),
+            'counts': self.counts,
+            'processes': self.processes,
+        }
+        # `np.savez` adds `.npz` if it's not there
+        with open(path, 'wb') as f:
+            np.savez_compressed(f,
+                    meta=json.dumps(meta),
+                    years=self.years,
+                    data=self.data,
+                    mix=self.mix)
+
+    def metric(self, name):
+        """`(session, year)` array of a metric."""
+        return self.data[:, :, self.metrics.index(name)]
+
+    def process(self, name):
+        """`(session, year)` array of a process' mix share."""
+        return self.mix[:, :, self.processes.index(name)]
+
+    def year(self, year):
+        """Index of `year` in `years`, `None` if it's outside them."""
+        if not len(self.years) or not self.years[0] <= year <= self.years[-1]:
+            return None
+        return year - self.years[0]
+
+    def reached(self, year):
+        """Which sessions got to `year` (none if it's outside `years`)."""
+        i = self.year(year)
+        if i is None:
+            return np.zeros(len(self.sessions), dtype=bool)
+        return ~np.isnan(self.data[:, i, 0])
+
+    def group(self, by):
+        """`{value: session mask}` for grouping by `'version'` (or `None` for all)."""
+        if by is None:
+            return {None: np.ones(len(self.sessions), dtype=bool)}
+        elif by == 'version':
+            return {v: self.versions == v for v in sorted(set(self.versions), key=str)}
+        raise ValueError('Unknown grouping: {}'.format(by))
+
+    def aggregate(self, values, fn, by=None):
+        """Apply `fn` (e.g. `np.nanmedian`) over sessions to a
+        `(session, year)` array, per group. Returns `{group: (year,) array}`."""
+        with warnings.catch_warnings():
+            # All-nan years (that no session reached) are expected
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return {g: fn(values[mask], axis=0) for g, mask in self.group(by).items()}
+
+    def median(self, metric, by=None):
+        """Median of a metric per year, e.g. `median('emissions', by='version')`."""
+        return self.aggregate(self.metric(metric), np.nanmedian, by)
+
+    def mean_mix(self, by=None):
+        """Mean mix share per year per process: `{group: (year, process) array}`."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return {g: np.nanmean(self.mix[mask], axis=0) for g, mask in self.group(by).items()}
+
+    def fraction(self, condition, year, by=None):
+        """Of the sessions that reached `year`, the fraction
+        for which the `(session, year)` boolean `condition` held
+        at some point up to (and including) `year`
+        (`nan` if no session did, e.g. `year` is outside `years`)."""
+        i = self.year(year)
+        if i is None:
+            return {g: np.nan for g in self.group(by)}
+        upto = condition[:, :i + 1].any(axis=1)
+        reached = self.reached(year)
+        return {g: upto[mask & reached].mean() if (mask & reached).any() else np.nan
+                for g, mask in self.group(by).items()}
+
+    def fraction_banned(self, process, year, by=None):
+        """Fraction of sessions that banned `process` by `year`. The game counts a
+        process as banned when its mix share is 0, but processes that haven't been
+        built up yet also have 0, so only a share that drops to 0 counts."""
+        share = self.process(process)
+        used = np.maximum.accumulate(np.nan_to_num(share) > 0, axis=1)
+        earlier = np.zeros_like(used)
+        earlier[:, 1:] = used[:, :-1]
+        return self.fraction((share == 0) & earlier, year, by)
+
+def fill_forward(arr):
+    """Fill `nan` rows of a `(year, ...)` array with the previous
+    non-`nan` row, up to the last non-`nan` row. Modifies `arr` in place."""
+    valid = ~np.isnan(arr).all(axis=tuple(range(1, arr.ndim)))
+    if not valid.any():
+        return
+    idx = np.where(valid, np.arange(len(arr)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    last = np.flatnonzero(valid)[-1]
+    arr[:last + 1] = arr[idx[:last + 1]]
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--cache', default='analytics.npz', help='Where to cache the loaded arrays')
+@click.option('--year', default=2040, help='Year for the process ban summary')
+def main(path, cache, year):
+    db = open_database(path)
+    t = Telemetry.load(db, cache=cache)
+    if not len(t.years):
+        print('No sessions with snapshots')
+        return
+    print('{} sessions, {}-{}'.format(len(t.sessions), t.years[0], t.years[-1]))
+
+    print('\nMedian emissions (Gt CO2eq) by version:')
+    for version, vals in t.median('emissions', by='version').items():
+        print(' ', version, np.round(vals[::10], 2))
+
+    print('\nFraction of sessions that banned by {}:'.format(year))
+    for process in t.processes:
+        print('  {}: {:.2f}'.format(process, t.fraction_banned(process, year)[None]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Read-only JSON endpoints for browsing sessions and their snapshots,
+served by both `main.py` and `asgi.py`:
+
+- `GET /sessions`: sessions, newest first. Query parameters:
+    - `version`, `useragent` (a substring), `start` and `end` (dates, `YYYY-MM-DD`) to filter by
+    - `limit` (page size) and `after` (the `next` cursor from the previous page)
+- `GET /sessions/<id>/snapshots`: a session's snapshots, in order. Query parameters:
+    - `fields`: comma-separated dotted paths to only return those parts
+      of each snapshot (e.g. `gameState.world,events`; see `read.FIELDS`)
+    - `from_year`, `to_year`: an inclusive range of years
+    - `limit` and `after` as above
+
+Responses have a `next` cursor (or `null` on the last page).
+Both use keyset pagination, so deep pages are as cheap as the first.
+"""
+
+from itertools import islice
+from datetime import datetime
+
+class BadQuery(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _int(params, name, default=None, max=None):
+    value = params.get(name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise BadQuery('{} should be an integer'.format(name))
+    if value < 1 and name == 'limit':
+        raise BadQuery('limit should be positive')
+    return value if max is None else min(value, max)
+
+def _date(params, name):
+    value = params.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise BadQuery('{} should be a date (YYYY-MM-DD)'.format(name))
+
+def list_sessions(db, params, max_limit=1000):
+    try:
+        sessions, cursor = db.page_sessions(
+                limit=_int(params, 'limit', 100, max_limit),
+                after=params.get('after'),
+                version=params.get('version'),
+                start=_date(params, 'start'),
+                end=_date(params, 'end'),
+                useragent=params.get('useragent'))
+    except ValueError:
+        raise BadQuery('Invalid cursor')
+    return {'success': True, 'sessions': sessions, 'next': cursor}
+
+def session_snapshots(db, session_id, params, max_limit=1000):
+    limit = _int(params, 'limit', 100, max_limit)
+    fields = params.get('fields')
+    years = (_int(params, 'from_year'), _int(params, 'to_year'))
+    snapshots = list(islice(db.iter_snapshots(session_id,
+        years=years,
+        fields=fields.split(',') if fields else None,
+        after=_int(params, 'after', 0),
+        batch_size=min(limit, 100)), limit))
+    cursor = snapshots[-1]['id'] if len(snapshots) == limit else None
+    return {'success': True, 'snapshots': snapshots, 'next': cursor}
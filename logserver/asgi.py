@@ -0,0 +1,335 @@
+"""
+Async alternative to `main.py`, with the same routes and JSON contract.
+
+Requests are handled on an asyncio event loop and only enqueue their writes;
+a dedicated writer task batches them and writes each batch in one transaction
+(on its own thread, since sqlite is blocking). This lets us hold open
+many concurrent clients cheaply.
+
+Run with an ASGI server, e.g.:
+
+    uvicorn asgi:app
+
+or `python asgi.py`. Uses the same `config.py` settings as `main.py`.
+"""
+
+import re
+import json
+import asyncio
+import logging
+import config
+import metrics
+import sentry_sdk
+from time import perf_counter
+from db import now
+from shards import ShardedDatabase
+import api
+import batch
+import sampling
+from server import db, sampler, live, batches, WRITER, LIVE_INTERVAL, \
+        MAX_BATCH_BYTES, MAX_BATCH_RECORDS, MAX_PAGE_SIZE
+from writer import write_batch, QueueFull
+from functools import partial
+from urllib.parse import parse_qsl
+from concurrent.futures import Future, ThreadPoolExecutor
+from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
+
+logger = logging.getLogger(__name__)
+
+sentry_sdk.init(
+    dsn=config.SENTRY_DSN,
+    # Exact counts are in `/metrics` regardless
+    traces_sample_rate=getattr(config, 'TRACES_SAMPLE_RATE', 1.0)
+)
+
+class AsyncWriter:
+    """The asyncio counterpart to `writer.Writer`."""
+
+    _STOP = object()
+
+    def __init__(self, db, max_queue=10000, batch_size=500,
+            flush_interval=1., put_timeout=0.5):
+        self.db = db
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        # Set by `start`
+        self.queue = None
+        self.task = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+
+        # All writes happen on this one thread, with one connection
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.con = await loop.run_in_executor(self.executor, self.db.writer_con)
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Flush everything that's queued and stop."""
+        if self.task is None:
+            return
+        await self.queue.put(self._STOP)
+        await self.task
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.con.close)
+        self.executor.shutdown()
+
+    async def add_session(self, session_id, version, user_agent):
+        await self._put(('session', (now(), session_id, version, user_agent)))
+
+    async def add_snapshot(self, session_id, snapshot, weight=1):
+        await self._put(('snapshot', (now(), session_id, snapshot, weight)))
+
+    async def add_snapshots(self, rows):
+        timestamp = now()
+        future = Future()
+        await self._put(('batch', ([(timestamp, session_id, snapshot, weight)
+            for session_id, snapshot, weight in rows], future)))
+        return await asyncio.wrap_future(future)
+
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def _put(self, item):
+        if self.task is None:
+            raise QueueFull('Writer hasn\'t started')
+        if self.task.done():
+            # Nothing would ever write it
+            raise QueueFull('Writer has stopped')
+        try:
+            await asyncio.wait_for(self.queue.put(item), timeout=self.put_timeout)
+        except asyncio.TimeoutError:
+            raise QueueFull('Write queue is full ({} items)'.format(self.max_queue))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        steps = batches(self.batch_size, self.flush_interval, self._STOP, clock=loop.time)
+        step = next(steps)
+        while True:
+            item = None
+            if isinstance(step, list):
+                try:
+                    await loop.run_in_executor(self.executor,
+                            write_batch, self.db, self.con, step)
+                except Exception:
+                    # `write_batch` handles bad rows itself, so this is a bug,
+                    # but keep writing the rest
+                    logger.exception('Failed to write batch')
+            else:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout=step)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                step = steps.send(item)
+            except StopIteration:
+                break
+
+writer = AsyncWriter(db, **WRITER)
+metrics.QUEUE_DEPTH.set_function(writer.depth)
+
+async def session(body, headers):
+    data = json.loads(body)
+    await writer.add_session(data['session_id'], data['version'], headers.get('user-agent'))
+    live.add_session(data['session_id'])
+    return {'success': True}
+
+async def snapshot(body, headers):
+    data = json.loads(body)
+    live.add_snapshot(data['session_id'], data['snapshot'])
+    weight = sampler.sample(data['session_id'], data['snapshot'])
+    if weight is not None:
+        await writer.add_snapshot(data['session_id'], data['snapshot'], weight)
+    return {'success': True}
+
+async def snapshots(body, headers):
+    rows, valid = batch.parse(body,
+            headers.get('content-encoding'),
+            MAX_BATCH_BYTES, MAX_BATCH_RECORDS)
+    for session_id, snapshot in rows:
+        live.add_snapshot(session_id, snapshot)
+    rows, keep = sampler.sample_batch(rows)
+    accepted = await writer.add_snapshots(rows) if rows else []
+    return {'success': True, 'accepted': batch.results(valid, sampling.results(keep, accepted))}
+
+ROUTES = {
+    '/session': session,
+    '/snapshot': snapshot,
+    '/snapshots': snapshots,
+}
+
+def route_name(path):
+    """The route pattern for metrics, so they're
+    not labelled per session id (or per bad path)"""
+    if path in ROUTES or path in ['/sessions', '/metrics', '/live']:
+        return path
+    elif re.fullmatch(r'/sessions/([^/]+)/snapshots', path):
+        return '/sessions/<session_id>/snapshots'
+    return 'unknown'
+
+def read_route(path, params):
+    """The read-only API call for a `GET` of `path`, or `None`"""
+    if path == '/sessions':
+        return partial(api.list_sessions, db, params, MAX_PAGE_SIZE)
+    match = re.fullmatch(r'/sessions/([^/]+)/snapshots', path)
+    if match:
+        return partial(api.session_snapshots, db, match.group(1), params, MAX_PAGE_SIZE)
+    return None
+
+async def respond(send, status, body, headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'access-control-allow-origin', b'*'),
+            *headers,
+        ],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': json.dumps(body).encode('utf8'),
+    })
+
+async def read_body(receive):
+    body = b''
+    more = True
+    while more:
+        message = await receive()
+        body += message.get('body', b'')
+        more = message.get('more_body', False)
+    return body
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await writer.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await writer.close()
+            if isinstance(db, ShardedDatabase):
+                await asyncio.get_running_loop().run_in_executor(None, db.close)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def live_events(receive, send):
+    """Send `live` events every `LIVE_INTERVAL` seconds until the client disconnects"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+    disconnect = asyncio.ensure_future(disconnected())
+    try:
+        while not disconnect.done():
+            await send({
+                'type': 'http.response.body',
+                'body': live.event().encode('utf8'),
+                'more_body': True,
+            })
+            await asyncio.wait([disconnect], timeout=LIVE_INTERVAL)
+    finally:
+        disconnect.cancel()
+
+async def get(scope, receive, send):
+    if scope['path'] == '/live':
+        return await live_events(receive, send)
+    elif scope['path'] == '/metrics':
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', metrics.CONTENT_TYPE.encode('latin1'))],
+        })
+        return await send({
+            'type': 'http.response.body',
+            'body': metrics.render().encode('utf8'),
+        })
+
+    params = dict(parse_qsl(scope['query_string'].decode('latin1')))
+    call = read_route(scope['path'], params)
+    if call is None:
+        return await respond(send, 404, {'success': False})
+    try:
+        # sqlite reads block, so run them off the event loop
+        result = await asyncio.get_running_loop().run_in_executor(None, call)
+    except api.BadQuery as e:
+        metrics.ERRORS.inc(route_name(scope['path']), type(e).__name__)
+        return await respond(send, e.status, {'success': False, 'error': str(e)})
+    await respond(send, 200, result)
+
+async def http(scope, receive, send):
+    if scope['method'] == 'GET':
+        return await get(scope, receive, send)
+
+    route = ROUTES.get(scope['path'])
+    if route is None:
+        return await respond(send, 404, {'success': False})
+
+    headers = {k.decode('latin1').lower(): v.decode('latin1') for k, v in scope['headers']}
+    if scope['method'] == 'OPTIONS':
+        # CORS preflight
+        allow_headers = headers.get('access-control-request-headers', '').encode('latin1')
+        return await respond(send, 200, {}, [
+            (b'access-control-allow-methods', b'POST, OPTIONS'),
+            (b'access-control-allow-headers', allow_headers),
+        ])
+    elif scope['method'] != 'POST':
+        return await respond(send, 405, {'success': False})
+
+    body = await read_body(receive)
+    metrics.REQUEST_BYTES.observe(len(body), scope['path'])
+    try:
+        result = await route(body, headers)
+    except QueueFull as e:
+        metrics.ERRORS.inc(scope['path'], type(e).__name__)
+        # Tell clients to back off and retry later
+        return await respond(send, 503, {'success': False, 'error': 'busy'},
+                [(b'retry-after', b'5')])
+    except batch.BadBatch as e:
+        metrics.ERRORS.inc(scope['path'], type(e).__name__)
+        return await respond(send, e.status, {'success': False, 'error': str(e)})
+    except (ValueError, KeyError, TypeError) as e:
+        metrics.ERRORS.inc(scope['path'], type(e).__name__)
+        return await respond(send, 400, {'success': False})
+    await respond(send, 200, result)
+
+async def instrumented(scope, receive, send):
+    """`http`, recording request counts and latencies"""
+    route = route_name(scope['path'])
+    status = [500]
+    async def send_status(message):
+        if message['type'] == 'http.response.start':
+            status[0] = message['status']
+        await send(message)
+
+    start = perf_counter()
+    try:
+        await http(scope, receive, send_status)
+    except Exception as e:
+        metrics.ERRORS.inc(route, type(e).__name__)
+        raise
+    finally:
+        metrics.REQUESTS.inc(route, status[0])
+        metrics.REQUEST_SECONDS.observe(perf_counter() - start, route)
+
+async def _app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http':
+        await instrumented(scope, receive, send)
+
+app = SentryAsgiMiddleware(_app)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app)
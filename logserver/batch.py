@@ -0,0 +1,75 @@
+"""
+Decoding for `/snapshots` batch uploads.
+
+The body is a JSON list of `{session_id, snapshot}` records,
+optionally gzip- or zstd-compressed (per the `Content-Encoding` header).
+"""
+
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class BadBatch(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def decompress(body, encoding, max_size):
+    """Decompress `body`, refusing to inflate past `max_size` bytes."""
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        data = body
+    elif encoding == 'gzip':
+        d = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        try:
+            data = d.decompress(body, max_size + 1)
+        except zlib.error:
+            raise BadBatch('Invalid gzip body')
+    elif encoding == 'zstd':
+        if zstandard is None:
+            raise BadBatch('zstd is not supported', status=415)
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(max_size + 1)
+        except zstandard.ZstdError:
+            raise BadBatch('Invalid zstd body')
+    else:
+        raise BadBatch('Unsupported Content-Encoding: {}'.format(encoding), status=415)
+
+    if len(data) > max_size:
+        raise BadBatch('Batch is too large', status=413)
+    return data
+
+def parse(body, encoding, max_size, max_records):
+    """Parse a batch upload.
+    Returns `(rows, valid)`, where `rows` are the `(session_id, snapshot)`
+    rows for the valid records, and `valid` is whether each record was valid."""
+    try:
+        records = json.loads(decompress(body, encoding, max_size))
+    except ValueError:
+        raise BadBatch('Invalid JSON')
+    if not isinstance(records, list):
+        raise BadBatch('Expected a list of records')
+    if len(records) > max_records:
+        raise BadBatch('Too many records (max {})'.format(max_records), status=413)
+
+    rows = []
+    valid = []
+    for r in records:
+        ok = isinstance(r, dict) \
+                and isinstance(r.get('session_id'), str) \
+                and isinstance(r.get('snapshot'), dict)
+        if ok:
+            rows.append((r['session_id'], r['snapshot']))
+        valid.append(ok)
+    return rows, valid
+
+def results(valid, accepted):
+    """Merge validity and insert results into
+    per-record acceptance, in the order the records were uploaded."""
+    accepted = iter(accepted)
+    return [ok and next(accepted) for ok in valid]
@@ -0,0 +1,97 @@
+"""
+zstd dictionary compression for stored snapshots.
+
+Snapshots repeat the same keys and process/project names in every row,
+so compressing each row with a dictionary trained on sample rows
+does much better than compressing rows on their own. To use it:
+
+    python codec.py train --db logs.db
+
+then set `COMPRESS_SNAPSHOTS = True` in `config.py` and restart the server.
+Dictionaries are kept in the database (`dictionaries`), and each row records
+which one it was compressed with, so retraining later doesn't affect older rows.
+
+To see how a database's latest dictionary does:
+
+    python codec.py bench --db logs.db
+
+Requires `zstandard`.
+"""
+
+import time
+import json
+import click
+import zstandard
+from partitions import open_database, PartitionedDatabase
+
+def latest(path):
+    """The database to train on/benchmark: for a partitioned
+    database, the latest partition (new partitions copy its dictionary)."""
+    db = open_database(path)
+    if isinstance(db, PartitionedDatabase):
+        keys = db.keys()
+        if not keys:
+            raise click.ClickException('No partitions in {}'.format(path))
+        return db.partition(keys[-1])
+    return db
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--samples', default=5000, help='Number of rows to train on')
+@click.option('--size', default=112640, help='Dictionary size in bytes')
+def train(path, samples, size):
+    """Train a dictionary on sample rows and add it to the database."""
+    db = latest(path)
+    texts = db.sample(samples)
+    print('Training on {} rows ({:.1f}MB)...'.format(len(texts), sum(len(t) for t in texts) / 1e6))
+    dictionary = zstandard.train_dictionary(size, texts)
+    id = db.add_dictionary(dictionary.as_bytes())
+    print('Added dictionary {} ({} bytes) to {}'.format(id, len(dictionary.as_bytes()), db.path))
+
+@main.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--samples', default=5000, help='Number of rows to benchmark on')
+@click.option('--level', default=3, help='Compression level')
+def bench(path, samples, level):
+    """Report the size reduction and decode throughput of the latest dictionary."""
+    db = latest(path)
+    dictionary = db.latest_dictionary()
+    if dictionary is None:
+        raise click.ClickException('No dictionary yet, run `python codec.py train` first')
+    dict_id, data = dictionary
+    dictionary = zstandard.ZstdCompressionDict(data)
+
+    texts = db.sample(samples)
+    raw = sum(len(t) for t in texts)
+    print('{} rows, {:.2f}MB as JSON'.format(len(texts), raw / 1e6))
+
+    plain = zstandard.ZstdCompressor(level=level)
+    with_dict = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+    sizes = {
+        'zstd': [plain.compress(t) for t in texts],
+        'zstd + dictionary {}'.format(dict_id): [with_dict.compress(t) for t in texts],
+    }
+    for name, blobs in sizes.items():
+        size = sum(len(b) for b in blobs)
+        print('  {}: {:.2f}MB ({:.1f}x smaller)'.format(name, size / 1e6, raw / size))
+
+    # Decoding is decompressing and parsing each row, as `Database.snapshots` does
+    def throughput(decode, rows):
+        start = time.perf_counter()
+        for row in rows:
+            json.loads(decode(row))
+        elapsed = time.perf_counter() - start
+        return '{:.0f} rows/s, {:.1f}MB/s of JSON'.format(len(rows) / elapsed, raw / elapsed / 1e6)
+
+    decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+    print('Decoding:')
+    print('  JSON: {}'.format(throughput(lambda t: t, texts)))
+    print('  zstd + dictionary {}: {}'.format(dict_id,
+        throughput(decompressor.decompress, sizes['zstd + dictionary {}'.format(dict_id)])))
+
+if __name__ == '__main__':
+    main()
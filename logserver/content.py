@@ -0,0 +1,132 @@
+"""
+Normalization of snapshots against their game version's static content.
+
+Every snapshot repeats the fields of each process, project, industry, NPC
+and region that come from the game's content (`parse_content.py`)
+and so are the same in every game of a version: names, ref ids,
+features, groups, base costs and so on. With `NORMALIZE_SNAPSHOTS = True`
+in `config.py`, keyframes are stored with those fields stripped from each entity
+wherever they match the version's content template, leaving only its dynamic
+values (by entity index), and the fields are filled back in when read.
+
+A version's template is taken from the first snapshot stored for it
+(it only keeps the `STATIC_FIELDS`), and kept in `content_templates`.
+Since only fields that match the template are stripped,
+normalizing never loses anything, even if a game changes a "static" field.
+
+To see how much it saves on a database's snapshots:
+
+    python content.py bench --db logs.db
+"""
+
+import json
+import click
+from delta import diff
+
+# Key under which a stripped entity lists the static fields it didn't have,
+# so they aren't filled in from the template
+MISSING = '_missing'
+
+# Path of each list of entities -> the fields of its entities that come from the content
+STATIC_FIELDS = {
+    'gameState.processes': ['id', 'ref_id', 'name', 'output', 'feedstock', 'features',
+        'resources', 'byproducts', 'supporters', 'opposers'],
+    'gameState.projects': ['id', 'ref_id', 'name', 'kind', 'group', 'ongoing', 'gradual',
+        'base_cost', 'required_majority', 'supporters', 'opposers'],
+    'gameState.industries': ['id', 'name', 'resources', 'byproducts'],
+    'gameState.npcs': ['id', 'name'],
+    'gameState.world.regions': ['id', 'name'],
+}
+
+def _entities(snapshot):
+    """`(path, entities)` for each list of entities in `snapshot`"""
+    for path in STATIC_FIELDS:
+        entities = snapshot
+        for k in path.split('.'):
+            entities = entities.get(k) if isinstance(entities, dict) else None
+        if isinstance(entities, list):
+            yield path, entities
+
+def template(snapshot):
+    """The content template of a snapshot: for each entity (by index),
+    its keys (to keep their order) and its `STATIC_FIELDS` values."""
+    return {path: [{
+        'keys': list(e),
+        'values': {k: e[k] for k in STATIC_FIELDS[path] if k in e},
+    } if isinstance(e, dict) else None for e in entities]
+        for path, entities in _entities(snapshot)}
+
+def _strip(entity, entry):
+    if not isinstance(entity, dict) or entry is None:
+        return entity
+    values = entry['values']
+    # `diff` tells `1` and `1.0` apart, `==` doesn't
+    stripped = {k: v for k, v in entity.items()
+            if k not in values or diff(v, values[k]) is not None}
+    missing = [k for k in values if k not in entity]
+    if missing:
+        stripped[MISSING] = missing
+    return stripped
+
+def strip(snapshot, template):
+    """A copy of `snapshot` without the static fields that match `template`.
+    Only what's stripped is copied, the rest is shared with `snapshot`."""
+    snapshot = dict(snapshot)
+    for path, entries in template.items():
+        *parents, key = path.split('.')
+        obj = snapshot
+        for k in parents:
+            if not isinstance(obj.get(k), dict):
+                break
+            obj[k] = dict(obj[k])
+            obj = obj[k]
+        else:
+            entities = obj.get(key)
+            if isinstance(entities, list):
+                obj[key] = [_strip(e, t) for e, t in zip(entities, entries)] + entities[len(entries):]
+    return snapshot
+
+def hydrate(snapshot, template):
+    """Fill the static fields `strip` removed back in, in place.
+    Also works on partial snapshots (with only some fields)."""
+    for path, entities in _entities(snapshot):
+        entries = template.get(path) or []
+        for i, (e, t) in enumerate(zip(entities, entries)):
+            if not isinstance(e, dict) or t is None:
+                continue
+            values = {k: v for k, v in t['values'].items() if k not in e.get(MISSING, [])}
+            entities[i] = {k: e[k] if k in e else values[k]
+                    for k in t['keys'] if k in e or k in values}
+            entities[i].update({k: v for k, v in e.items() if k not in entities[i] and k != MISSING})
+    return snapshot
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--sessions', 'n_sessions', default=50, help='Number of sessions to measure')
+def bench(path, n_sessions):
+    """Report how much smaller normalized snapshots are."""
+    # `db` imports this module
+    from partitions import open_database
+    db = open_database(path)
+    sessions, _ = db.page_sessions(limit=n_sessions)
+    templates = {}
+    full = normalized = n = 0
+    for session in sessions:
+        for s in db.iter_snapshots(session['id']):
+            t = templates.setdefault(session['version'], template(s['snapshot']))
+            full += len(json.dumps(s['snapshot']))
+            normalized += len(json.dumps(strip(s['snapshot'], t)))
+            n += 1
+    if not n:
+        raise click.ClickException('No snapshots in {}'.format(path))
+    print('{} snapshots from {} sessions'.format(n, len(sessions)))
+    print('  Full: {:.1f}KB per snapshot'.format(full / n / 1e3))
+    print('  Normalized: {:.1f}KB per snapshot ({:.1f}x smaller)'.format(
+        normalized / n / 1e3, full / normalized))
+
+if __name__ == '__main__':
+    main()
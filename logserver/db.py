@@ -1,60 +1,951 @@
 import json
 import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
+from delta import diff, patch, subdelta
+import rollups
+import metrics
+import content
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# How many sessions to keep keyframes in memory for
+KEYFRAME_CACHE_SIZE = 1024
+
+# Bump this and add a migration to `migrate.py`
+# whenever the schema below changes.
+SCHEMA_VERSION = 9
+
+# Table -> statements to create it (and its indices)
+SCHEMA = {
+    'sessions': [
+        'CREATE TABLE IF NOT EXISTS sessions \
+            (session text primary key,\
+            version text,\
+            timestamp text,\
+            useragent text)',
+
+        # For paging through sessions newest first (see `page_sessions`)
+        'CREATE INDEX IF NOT EXISTS sessions_timestamp ON sessions(CAST(timestamp AS real), session)',
+        'CREATE INDEX IF NOT EXISTS sessions_version ON sessions(version, CAST(timestamp AS real), session)',
+    ],
+    'snapshots': [
+        'CREATE TABLE IF NOT EXISTS snapshots \
+            (id integer primary key autoincrement,\
+            timestamp text not null,\
+            session text not null,\
+            snapshot json not null,\
+            dict integer,\
+            base integer,\
+            year integer,\
+            temperature real,\
+            emissions real,\
+            political_capital integer,\
+            weight integer,\
+            hash integer,\
+            content integer)',
+        'CREATE INDEX IF NOT EXISTS snapshots_session ON snapshots(session, timestamp)',
+
+        # For skipping resent copies of snapshots (see `content_hash`)
+        'CREATE INDEX IF NOT EXISTS snapshots_hash ON snapshots(session, hash)',
+        'CREATE INDEX IF NOT EXISTS snapshots_temperature ON snapshots(year, temperature)',
+        'CREATE INDEX IF NOT EXISTS snapshots_emissions ON snapshots(year, emissions)',
+        'CREATE INDEX IF NOT EXISTS snapshots_political_capital ON snapshots(year, political_capital)',
+    ],
+
+    # Kept up to date on insert so that
+    # browsing sessions never has to touch `snapshots`
+    'session_stats': [
+        'CREATE TABLE IF NOT EXISTS session_stats \
+            (session text primary key,\
+            version text,\
+            n_snapshots integer not null default 0,\
+            first_year integer,\
+            last_year integer,\
+            last_timestamp real,\
+            n_duplicates integer not null default 0)',
+    ],
+
+    # zstd dictionaries for compressing snapshots (see `codec.py`).
+    # Compressed snapshots keep the id of theirs in `snapshots.dict`,
+    # so dictionaries are never changed or removed once added.
+    'dictionaries': [
+        'CREATE TABLE IF NOT EXISTS dictionaries \
+            (id integer primary key autoincrement,\
+            timestamp real not null,\
+            data blob not null)',
+    ],
+
+    # Templates of each game version's static content (see `content.py`).
+    # Normalized snapshots keep the id of theirs in `snapshots.content`.
+    'content_templates': [
+        'CREATE TABLE IF NOT EXISTS content_templates \
+            (id integer primary key autoincrement,\
+            version text not null,\
+            timestamp real not null,\
+            data json not null)',
+    ],
+
+    # Rollups across sessions, also kept up to date on insert (see `rollups.py`)
+    'rollup_state': [
+        'CREATE TABLE IF NOT EXISTS rollup_state \
+            (session text primary key,\
+            version text not null,\
+            last_year integer,\
+            projects json not null)',
+    ],
+    'project_transitions': [
+        'CREATE TABLE IF NOT EXISTS project_transitions \
+            (version text not null,\
+            project text not null,\
+            from_status text not null,\
+            to_status text not null,\
+            n integer not null,\
+            primary key (version, project, from_status, to_status))',
+    ],
+    'project_sessions': [
+        'CREATE TABLE IF NOT EXISTS project_sessions \
+            (version text not null,\
+            project text not null,\
+            status text not null,\
+            n integer not null,\
+            primary key (version, project, status))',
+    ],
+    'process_mix': [
+        'CREATE TABLE IF NOT EXISTS process_mix \
+            (version text not null,\
+            bucket integer not null,\
+            process text not null,\
+            mix_share integer not null,\
+            n integer not null,\
+            primary key (version, bucket, process, mix_share))',
+    ],
+    'years_reached': [
+        'CREATE TABLE IF NOT EXISTS years_reached \
+            (version text not null,\
+            year integer not null,\
+            n integer not null,\
+            primary key (version, year))',
+    ],
+}
+
+# Columns that can be added to older databases in place
+COLUMNS = {
+    'snapshots': [('base', 'integer'), ('year', 'integer'),
+        ('temperature', 'real'), ('emissions', 'real'), ('political_capital', 'integer'),
+        ('dict', 'integer'), ('weight', 'integer'), ('hash', 'integer'),
+        ('content', 'integer')],
+    'session_stats': [('n_duplicates', 'integer not null default 0')],
+}
+
+# Snapshot fields that are also kept in their own columns
+# (which are indexed along with `year`), so they can be
+# filtered on in sqlite without decoding snapshots; see `Database.query`.
+# These can't be generated columns since most rows are deltas.
+FIELD_COLUMNS = {
+    'temperature': lambda s: s['gameState']['world']['temperature'],
+    'emissions': lambda s: gtco2eq(s['gameState']['world']),
+    'political_capital': lambda s: s['gameState']['political_capital'],
+}
+
+# Comparisons `Database.query` accepts
+OPS = ['==', '!=', '<', '<=', '>', '>=']
+
+def now():
+    return datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+
+def gtco2eq(byproducts):
+    co2eq = byproducts['co2_emissions'] + byproducts['ch4_emissions'] * 36 + byproducts['n2o_emissions'] * 298
+    return co2eq * 1e-15
+
+def content_hash(snapshot):
+    """64-bit hash of a snapshot's content, to spot copies that clients resent.
+    Resent copies are parsed from the same JSON, so key order can be relied on."""
+    digest = hashlib.blake2b(json.dumps(snapshot).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def snapshot_year(snapshot):
+    """The snapshot's in-game year, `None` if it's missing or not a number"""
+    try:
+        year = snapshot['gameState']['world']['year']
+    except (KeyError, TypeError, IndexError):
+        return None
+    return year if isinstance(year, int) and not isinstance(year, bool) else None
+
+def field_columns(snapshot):
+    """Values for the `FIELD_COLUMNS`, `None` where missing"""
+    values = []
+    for fn in FIELD_COLUMNS.values():
+        try:
+            values.append(fn(snapshot))
+        except (KeyError, TypeError):
+            values.append(None)
+    return values
+
+def json_path(field):
+    """sqlite JSON path for a dotted field path"""
+    return '$' + ''.join('."{}"'.format(k) for k in field.split('.'))
+
+def get_path(obj, path):
+    for k in path:
+        obj = obj.get(k) if isinstance(obj, dict) else None
+    return obj
+
+def session_row(row):
+    timestamp, session, version, useragent, n_snapshots, first_year, last_year, last_timestamp, n_duplicates = row
+    return {
+        'id': session,
+        'timestamp': timestamp,
+        'version': version,
+        'useragent': useragent,
+        'n_snapshots': n_snapshots,
+        'first_year': first_year,
+        'last_year': last_year,
+        'last_timestamp': last_timestamp,
+        'n_duplicates': n_duplicates,
+    }
+
+# The fields of a session that come from `session_stats`
+STATS_FIELDS = ['n_snapshots', 'first_year', 'last_year', 'last_timestamp', 'n_duplicates']
+
+def make_cursor(session):
+    """Cursor for the page of sessions after `session` (see `Database.page_sessions`)"""
+    return '{}:{}'.format(float(session['timestamp']), session['id'])
+
+def parse_cursor(cursor):
+    """`(timestamp, session id)` of a cursor. Raises `ValueError` if it's malformed."""
+    timestamp, session_id = cursor.split(':', 1)
+    return float(timestamp), session_id
+
+def set_path(obj, path, value):
+    for k in path[:-1]:
+        obj = obj.setdefault(k, {})
+    obj[path[-1]] = value
 
 class Database:
-    def __init__(self, path):
+    """Snapshots are stored as keyframes and deltas:
+    every `keyframe_interval`-th snapshot of a session is stored in full
+    and the ones in between are stored as a delta (see `delta.py`)
+    against that keyframe, whose rowid is kept in `base`.
+    Deltas are against the keyframe rather than the previous snapshot so that
+    any snapshot can be rebuilt from exactly two rows.
+
+    With `compress=True`, new rows are compressed with the latest
+    zstd dictionary in `dictionaries` (if there is one yet; see `codec.py`).
+    Compressed rows are decompressed transparently when read.
+
+    With `normalize=True`, new snapshots are stored without the static
+    content fields that match their version's template (see `content.py`),
+    which are filled back in when read. A keyframe's deltas use its template."""
+
+    def __init__(self, path, keyframe_interval=20, compress=False, compression_level=3, normalize=False):
         self.path = path
-        _, cur = self._con()
-        cur.execute('CREATE TABLE IF NOT EXISTS sessions \
-                (session text primary key,\
-                version text,\
-                timestamp text,\
-                useragent text)')
-        cur.execute('CREATE TABLE IF NOT EXISTS snapshots \
-                (timestamp text primary key,\
-                session text,\
-                snapshot json not null)')
+        self.keyframe_interval = keyframe_interval
+        self.normalize = normalize
+
+        # content template id -> template
+        self._templates = {}
+
+        if compress and zstandard is None:
+            raise RuntimeError('Compressing snapshots requires zstandard')
+        self.compress = compress
+        self.compression_level = compression_level
+
+        # session_id -> [keyframe rowid, keyframe snapshot (as stored), deltas since keyframe, content template id]
+        self._keyframes = OrderedDict()
+        self._lock = threading.Lock()
+
+        # dictionary id -> `zstandard.ZstdCompressionDict`
+        self._dicts = {}
+
+        # (dictionary id, compressor) for the latest dictionary;
+        # only used by inserts, which hold `_lock`
+        self._compressor = None
+
+        # Decompressors per thread, since they aren't thread-safe
+        self._local = threading.local()
+
+        con, cur = self._con()
+        version, = cur.execute('PRAGMA user_version').fetchone()
+        exists = cur.execute(
+                "SELECT 1 FROM sqlite_master WHERE type == 'table' AND name == 'snapshots'").fetchone()
+        if not exists:
+            for stmts in SCHEMA.values():
+                for stmt in stmts:
+                    cur.execute(stmt)
+            cur.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        elif version < SCHEMA_VERSION:
+            # Add any missing tables and columns so we can keep
+            # serving the older schema; the rest is left to `migrate.py`
+            tables = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type == 'table'")]
+            for table, stmts in SCHEMA.items():
+                if table not in tables:
+                    for stmt in stmts:
+                        cur.execute(stmt)
+            for table, cols in COLUMNS.items():
+                existing = [row[1] for row in cur.execute('PRAGMA table_info({})'.format(table))]
+                for col, typ in cols:
+                    if col not in existing:
+                        cur.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, col, typ))
+            print('{} schema is version {}, run `python migrate.py` to upgrade to version {}'.format(
+                path, version, SCHEMA_VERSION))
+        con.commit()
 
     def _con(self):
         con = sqlite3.connect(self.path)
         cur = con.cursor()
         return con, cur
 
+    def writer_con(self):
+        """Long-lived connection for a single writer thread.
+        WAL lets readers (e.g. `read.py`) keep working while
+        the writer holds the lock, and synchronous=NORMAL
+        means we only fsync on checkpoints rather than on every commit."""
+        con = sqlite3.connect(self.path, check_same_thread=False)
+        con.execute('PRAGMA journal_mode=WAL')
+        con.execute('PRAGMA synchronous=NORMAL')
+        return con
+
     def add_session(self, session_id, version, user_agent):
-        timestamp = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
-        con, cur = self._con()
-        cur.execute(
+        con, _ = self._con()
+        self.write(con, [(now(), session_id, version, user_agent)], [])
+
+    def add_snapshot(self, session_id, snapshot, weight=1):
+        con, _ = self._con()
+        self.write(con, [], [(now(), session_id, snapshot, weight)])
+
+    def add_snapshots(self, rows):
+        """Insert `(session_id, snapshot, weight)` rows; see `write_snapshot_batch`."""
+        con, _ = self._con()
+        timestamp = now()
+        return self.write_snapshot_batch(con, [(timestamp, session_id, snapshot, weight)
+            for session_id, snapshot, weight in rows])
+
+    def write(self, con, sessions, snapshots):
+        """Insert session and snapshot rows (see `insert_sessions`
+        and `insert_snapshots`) in one transaction."""
+        cur = con.cursor()
+        try:
+            with metrics.INSERT_SECONDS.time():
+                self.insert_sessions(cur, sessions)
+                n = self.insert_snapshots(cur, snapshots)
+        except:
+            con.rollback()
+            raise
+        with metrics.COMMIT_SECONDS.time():
+            con.commit()
+        metrics.ROWS_WRITTEN.inc('sessions', n=len(sessions))
+        metrics.ROWS_WRITTEN.inc('snapshots', n=n)
+        metrics.DUPLICATES.inc(n=len(snapshots) - n)
+
+    def write_snapshot_batch(self, con, rows):
+        """Insert `(timestamp, session_id, snapshot, weight)` rows in one transaction,
+        each in its own savepoint so that a bad row doesn't fail the rest.
+        Returns whether each row was accepted (inserted or a duplicate)."""
+        accepted = []
+        n = 0
+        cur = con.cursor()
+        try:
+            with metrics.INSERT_SECONDS.time():
+                # Otherwise the savepoint would start (and its release commit)
+                # a transaction of its own
+                if not con.in_transaction:
+                    cur.execute('BEGIN')
+                for row in rows:
+                    cur.execute('SAVEPOINT record')
+                    try:
+                        n += self.insert_snapshots(cur, [row])
+                        accepted.append(True)
+                    except Exception:
+                        logger.exception('Failed to write snapshot in batch')
+                        cur.execute('ROLLBACK TO record')
+                        accepted.append(False)
+                    cur.execute('RELEASE record')
+        except:
+            con.rollback()
+            raise
+        with metrics.COMMIT_SECONDS.time():
+            con.commit()
+        metrics.ROWS_WRITTEN.inc('snapshots', n=n)
+        metrics.DUPLICATES.inc(n=sum(accepted) - n)
+        return accepted
+
+    def insert_sessions(self, cur, rows):
+        """Insert `(timestamp, session_id, version, user_agent)` rows.
+        Does not commit, so callers can batch several inserts into one transaction."""
+        cur.executemany(
             'INSERT OR IGNORE INTO sessions(session, version, timestamp, useragent) VALUES (?,?,?,?)',
-            (session_id, version, timestamp, user_agent))
-        con.commit()
+            [(session_id, version, timestamp, user_agent)
+                for timestamp, session_id, version, user_agent in rows])
+
+        # In case snapshots arrived before their session
+        cur.executemany(
+            'UPDATE session_stats SET version = ? WHERE session == ? AND version IS NULL',
+            [(version, session_id) for _, session_id, version, _ in rows])
+
+    def insert_snapshots(self, cur, rows, rollup=True):
+        """Insert `(timestamp, session_id, snapshot, weight)` rows, where `weight`
+        is how many snapshots this one stands in for (see `sampling.py`).
+        Snapshots identical to one already in their session are skipped
+        (and counted in `session_stats.n_duplicates`).
+        Does not commit, so callers can batch several inserts into one transaction.
+        `rollup=False` leaves the rollups (see `rollups.py`) as they are.
+        Returns the number of snapshots inserted."""
+        # session_id -> [n_snapshots, first_year, last_year, last_timestamp, n_duplicates]
+        stats = {}
+        inserted = []
+        with self._lock:
+            try:
+                for timestamp, session_id, snapshot, weight in rows:
+                    s = stats.setdefault(session_id, [0, None, None, float(timestamp), 0])
+                    s[3] = max(s[3], float(timestamp))
+                    hash = content_hash(snapshot)
+                    if cur.execute('SELECT 1 FROM snapshots WHERE session == ? AND hash == ?',
+                            (session_id, hash)).fetchone():
+                        s[4] += 1
+                        continue
+
+                    year = snapshot_year(snapshot)
+                    self._insert_snapshot(cur, timestamp, session_id, snapshot, year, weight, hash)
+                    inserted.append((session_id, snapshot, weight))
+                    s[0] += 1
+                    if year is not None:
+                        s[1] = year if s[1] is None else min(s[1], year)
+                        s[2] = year if s[2] is None else max(s[2], year)
+                self._update_stats(cur, stats)
+                if rollup:
+                    rollups.update(cur, inserted)
+            except:
+                # The transaction will be rolled back,
+                # so the cached keyframes (and templates) may no longer exist
+                for session_id in stats:
+                    self._keyframes.pop(session_id, None)
+                self._templates.clear()
+                raise
+        return len(inserted)
+
+    def _update_stats(self, cur, stats):
+        cur.executemany(
+            'INSERT INTO session_stats(session, version, n_snapshots, first_year, last_year, last_timestamp, n_duplicates) \
+                    VALUES (?, (SELECT version FROM sessions WHERE session == ?), ?, ?, ?, ?, ?) \
+                ON CONFLICT(session) DO UPDATE SET \
+                    version = COALESCE(version, excluded.version), \
+                    n_snapshots = n_snapshots + excluded.n_snapshots, \
+                    first_year = MIN(COALESCE(first_year, excluded.first_year), COALESCE(excluded.first_year, first_year)), \
+                    last_year = MAX(COALESCE(last_year, excluded.last_year), COALESCE(excluded.last_year, last_year)), \
+                    last_timestamp = MAX(COALESCE(last_timestamp, excluded.last_timestamp), excluded.last_timestamp), \
+                    n_duplicates = n_duplicates + excluded.n_duplicates',
+            [(session_id, session_id, *s) for session_id, s in stats.items()])
+
+    def _insert_snapshot(self, cur, timestamp, session_id, snapshot, year, weight, hash):
+        key = self._keyframe(cur, session_id)
+        insert = 'INSERT INTO snapshots(timestamp, session, snapshot, dict, base, content, year, weight, hash, {}) \
+                VALUES (?,?,?,?,?,?,?,?,?,{})'.format(', '.join(FIELD_COLUMNS), ','.join('?' for _ in FIELD_COLUMNS))
+        (data, dict_id, base, content_id), stored = self._stored(cur, session_id, snapshot, key)
+        cur.execute(insert, (timestamp, session_id, data, dict_id, base, content_id,
+            year, weight, hash, *field_columns(snapshot)))
+        if base is None:
+            self._cache_keyframe(session_id, [cur.lastrowid, stored, 0, content_id])
+        else:
+            key[2] += 1
+
+    def _stored(self, cur, session_id, snapshot, key):
+        """`((data, dictionary id, base, content id), stored snapshot)` to store
+        `snapshot` as, given its session's latest keyframe `key`
+        (`[rowid, stored keyframe, n deltas, content id]`, or `None`):
+        a new keyframe (`base` is `None`) or a delta against `key`'s keyframe."""
+        if key is None or key[2] >= self.keyframe_interval - 1:
+            content_id = self._content_template_id(cur, session_id, snapshot) if self.normalize else None
+            stored = self._strip(cur, snapshot, content_id)
+            return (*self._encode(cur, stored), None, content_id), stored
+        rowid, keyframe, _, content_id = key
+        stored = self._strip(cur, snapshot, content_id)
+        return (*self._encode(cur, diff(keyframe, stored)), rowid, content_id), stored
+
+    def _content_template_id(self, cur, session_id, snapshot):
+        """Id of the content template for the session's version,
+        taking it from `snapshot` if there isn't one yet.
+        `None` if the session's version isn't known (yet)."""
+        version, = cur.execute('SELECT version FROM sessions WHERE session == ?',
+                (session_id,)).fetchone() or (None,)
+        if version is None:
+            return None
+        content_id, = cur.execute('SELECT MAX(id) FROM content_templates WHERE version == ?',
+                (version,)).fetchone()
+        if content_id is None:
+            cur.execute('INSERT INTO content_templates(version, timestamp, data) VALUES (?,?,?)',
+                    (version, now(), json.dumps(content.template(snapshot))))
+            content_id = cur.lastrowid
+        return content_id
 
-    def add_snapshot(self, session_id, snapshot):
-        timestamp = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+    def _content_template(self, cur, content_id):
+        template = self._templates.get(content_id)
+        if template is None:
+            data, = cur.execute('SELECT data FROM content_templates WHERE id == ?', (content_id,)).fetchone()
+            template = self._templates[content_id] = json.loads(data)
+        return template
+
+    def _strip(self, cur, snapshot, content_id):
+        if content_id is None:
+            return snapshot
+        return content.strip(snapshot, self._content_template(cur, content_id))
+
+    def _encode(self, cur, obj):
+        """`(stored value, dictionary id)` for a snapshot or delta"""
+        text = json.dumps(obj)
+        if not self.compress:
+            return text, None
+        dict_id, = cur.execute('SELECT MAX(id) FROM dictionaries').fetchone()
+        if dict_id is None:
+            return text, None
+        if self._compressor is None or self._compressor[0] != dict_id:
+            self._compressor = (dict_id, zstandard.ZstdCompressor(
+                level=self.compression_level, dict_data=self._dictionary(cur, dict_id)))
+        return self._compressor[1].compress(text.encode('utf8')), dict_id
+
+    def _text(self, cur, data, dict_id):
+        """The JSON text of a stored snapshot or delta"""
+        if dict_id is None:
+            return data
+        if zstandard is None:
+            raise RuntimeError('Reading compressed snapshots requires zstandard')
+        decompressors = self._local.__dict__.setdefault('decompressors', {})
+        if dict_id not in decompressors:
+            decompressors[dict_id] = zstandard.ZstdDecompressor(dict_data=self._dictionary(cur, dict_id))
+        return decompressors[dict_id].decompress(data)
+
+    def _dictionary(self, cur, dict_id):
+        if dict_id not in self._dicts:
+            data, = cur.execute('SELECT data FROM dictionaries WHERE id == ?', (dict_id,)).fetchone()
+            self._dicts[dict_id] = zstandard.ZstdCompressionDict(data)
+        return self._dicts[dict_id]
+
+    def add_dictionary(self, data):
+        """Add a zstd dictionary (as bytes). With `compress=True`,
+        new snapshots are compressed with it from then on. Returns its id."""
         con, cur = self._con()
-        cur.execute(
-            'INSERT INTO snapshots(timestamp, session, snapshot) VALUES (?,?,?)',
-            (timestamp, session_id, json.dumps(snapshot)))
-        con.commit()
+        with con:
+            cur.execute('INSERT INTO dictionaries(timestamp, data) VALUES (?,?)', (now(), data))
+        con.close()
+        return cur.lastrowid
+
+    def latest_dictionary(self):
+        """`(id, data)` of the latest dictionary, or `None`"""
+        con, cur = self._con()
+        row = cur.execute('SELECT id, data FROM dictionaries ORDER BY id DESC LIMIT 1').fetchone()
+        con.close()
+        return row
+
+    def sample(self, n):
+        """JSON text of `n` random rows (keyframes and deltas) as they're stored,
+        e.g. for training a dictionary on."""
+        con, cur = self._con()
+        rows = cur.execute('SELECT snapshot, dict FROM snapshots ORDER BY RANDOM() LIMIT ?', (n,)).fetchall()
+        texts = [self._text(cur, data, dict_id) for data, dict_id in rows]
+        con.close()
+        return [t.encode('utf8') if isinstance(t, str) else t for t in texts]
+
+    def _keyframe(self, cur, session_id):
+        key = self._keyframes.get(session_id)
+
+        # Make sure the keyframe hasn't since been removed or re-encoded
+        # (e.g. by `downsample` in another process). Ids are never reused,
+        # and a re-encoded row keeps its snapshot, so if it's still a keyframe
+        # stripped against the same content template, it's stored the same.
+        if key is not None and cur.execute(
+                'SELECT 1 FROM snapshots WHERE rowid == ? AND base IS NULL AND content IS ?',
+                (key[0], key[3])).fetchone():
+            self._keyframes.move_to_end(session_id)
+            return key
+
+        row = cur.execute(
+                'SELECT rowid, snapshot, dict, content FROM snapshots WHERE session == ? AND base IS NULL \
+                        ORDER BY rowid DESC LIMIT 1',
+                (session_id,)).fetchone()
+        if row is None:
+            return None
+        rowid, snapshot, dict_id, content_id = row
+        n_deltas, = cur.execute(
+                'SELECT COUNT(*) FROM snapshots WHERE session == ? AND rowid > ?',
+                (session_id, rowid)).fetchone()
+        key = [rowid, json.loads(self._text(cur, snapshot, dict_id)), n_deltas, content_id]
+        self._cache_keyframe(session_id, key)
+        return key
+
+    def _cache_keyframe(self, session_id, key):
+        self._keyframes[session_id] = key
+        self._keyframes.move_to_end(session_id)
+        while len(self._keyframes) > KEYFRAME_CACHE_SIZE:
+            self._keyframes.popitem(last=False)
+
+    def has_session(self, session_id):
+        _, cur = self._con()
+        return cur.execute(
+                'SELECT 1 FROM sessions WHERE session == ? \
+                UNION ALL SELECT 1 FROM session_stats WHERE session == ? LIMIT 1',
+                (session_id, session_id)).fetchone() is not None
+
+    def downsample(self, before, every=5):
+        """Thin out the snapshots of sessions whose last snapshot
+        was before the `before` timestamp, keeping the last snapshot of every
+        `every`th year (counting from the session's first year)
+        plus the session's final snapshot. Returns the number of snapshots removed."""
+        con, cur = self._con()
+        sessions = cur.execute(
+                'SELECT session, n_snapshots, first_year, last_year FROM session_stats \
+                        WHERE last_timestamp < ?', (before,)).fetchall()
+        removed = 0
+        for session_id, n_snapshots, first_year, last_year in sessions:
+            # Skip sessions that are already downsampled
+            if first_year is None or n_snapshots <= (last_year - first_year)//every + 2:
+                continue
+
+            snapshots = list(self.iter_snapshots(session_id))
+            keep = {}
+            for s in snapshots[:-1]:
+                year = snapshot_year(s['snapshot'])
+                if year is not None and (year - first_year) % every == 0:
+                    keep[year] = s
+            keep = list(keep.values()) + snapshots[-1:]
+            if len(keep) == len(snapshots):
+                continue
+
+            # Kept snapshots also stand in for the ones removed before them
+            kept = {s['id'] for s in keep}
+            weights = {}
+            weight = 0
+            for s in snapshots:
+                weight += s['weight']
+                if s['id'] in kept:
+                    weights[s['id']] = weight
+                    weight = 0
+
+            # Delete the others and re-encode the kept ones in place,
+            # so their keyframes/deltas no longer refer to deleted rows
+            # but their ids (e.g. `export.py`'s watermark) stay the same.
+            # The rollups already cover these snapshots.
+            with self._lock, con:
+                self._keyframes.pop(session_id, None)
+                cur.executemany('DELETE FROM snapshots WHERE id == ?',
+                        [(s['id'],) for s in snapshots if s['id'] not in kept])
+                key = None
+                for s in keep:
+                    (data, dict_id, base, content_id), stored = self._stored(cur, session_id, s['snapshot'], key)
+                    cur.execute('UPDATE snapshots SET snapshot = ?, dict = ?, base = ?, content = ?, weight = ? \
+                            WHERE id == ?', (data, dict_id, base, content_id, weights[s['id']], s['id']))
+                    if base is None:
+                        key = [s['id'], stored, 0, content_id]
+                    else:
+                        key[2] += 1
+                # Keeping the session's other stats (e.g. `n_duplicates`)
+                cur.execute('UPDATE session_stats SET n_snapshots = ? WHERE session == ?',
+                        (len(keep), session_id))
+            removed += len(snapshots) - len(keep)
+        return removed
+
+    def vacuum(self):
+        con, cur = self._con()
+        cur.execute('VACUUM')
+        con.close()
+
+    def _select(self, fields):
+        """Query (and its params) selecting
+        `(rowid, timestamp, session, weight, base, dict, content, snapshot, *parts)`.
+        If `fields` is given, uncompressed keyframes come back as just the JSON for each field
+        (in `parts`, extracted by sqlite) rather than in full in `snapshot`."""
+        if fields is None:
+            return 'SELECT rowid, timestamp, session, COALESCE(weight, 1), base, dict, content, snapshot \
+                    FROM snapshots', []
+        return 'SELECT rowid, timestamp, session, COALESCE(weight, 1), base, dict, content, \
+                    CASE WHEN base IS NULL AND dict IS NULL THEN NULL ELSE snapshot END, {} \
+                FROM snapshots'.format(', '.join(
+                    'CASE WHEN base IS NULL AND dict IS NULL THEN json_quote(json_extract(snapshot, ?)) END'
+                    for _ in fields)), [json_path(f) for f in fields]
+
+    def _keyframe_text(self, cur, snapshot, dict_id, parts, paths):
+        """What `_decode` keeps of a keyframe: its JSON text or,
+        given `paths`, the JSON text of each field"""
+        if paths is None:
+            return self._text(cur, snapshot, dict_id)
+        elif snapshot is None:
+            # Already extracted by sqlite
+            return parts
+        state = json.loads(self._text(cur, snapshot, dict_id))
+        return [json.dumps(get_path(state, path)) for path in paths]
+
+    def _decode(self, cur, rows, fields=None):
+        """Rebuild snapshots from rows selected with `_select(fields)`."""
+        paths = None if fields is None else [f.split('.') for f in fields]
+
+        # rowid -> keyframe JSON text(s). We keep the text
+        # rather than the parsed keyframe because `patch`
+        # modifies in place and parsing gives us a fresh copy.
+        # Only a few are kept, since deltas are almost always
+        # against the most recent keyframe of their session.
+        keyframes = OrderedDict()
+        for rowid, timestamp, session, weight, base, dict_id, content_id, snapshot, *parts in rows:
+            if base is None:
+                key = rowid
+                keyframes[key] = self._keyframe_text(cur, snapshot, dict_id, parts, paths)
+                delta = None
+            else:
+                key = base
+                if key not in keyframes:
+                    query, params = self._select(fields)
+                    row = cur.execute('{} WHERE rowid == ?'.format(query),
+                            params + [key]).fetchone()
+                    keyframes[key] = self._keyframe_text(cur, row[7], row[5], row[8:], paths)
+                delta = json.loads(self._text(cur, snapshot, dict_id))
+            while len(keyframes) > 4:
+                keyframes.popitem(last=False)
+
+            if paths is None:
+                state = patch(json.loads(keyframes[key]), delta)
+            else:
+                state = {}
+                for path, text in zip(paths, keyframes[key]):
+                    value = json.loads(text)
+                    if delta is not None:
+                        value = patch(value, subdelta(delta, path))
+                    set_path(state, path, value)
+            if content_id is not None:
+                content.hydrate(state, self._content_template(cur, content_id))
 
-    def snapshots(self, session_id):
+            yield {
+                'id': rowid,
+                'session_id': session,
+                'timestamp': timestamp,
+                'weight': weight,
+                'snapshot': state,
+            }
+
+    def iter_snapshots(self, session_id, years=None, fields=None, batch_size=100, after=0):
+        """Lazily yield a session's snapshots, fetching `batch_size` rows at a time,
+        starting after the snapshot with id `after`.
+
+        `years` is an optional inclusive `(start, end)` range (either can be `None`).
+        `fields` is an optional list of dotted paths (e.g. `['gameState.world', 'events']`);
+        if given, only those parts of each snapshot are decoded and returned
+        (in the same structure, e.g. `s['snapshot']['gameState']['world']`).
+        Each snapshot's `weight` is how many snapshots it stands in for: more than 1
+        if some before it were dropped by sampling (see `sampling.py`) or `downsample`."""
+        con, cur = self._con()
+        query, params = self._select(fields)
+        where = 'session == ?'
+        params += [session_id]
+        if years is not None:
+            start, end = years
+            if start is not None:
+                where += ' AND year >= ?'
+                params.append(start)
+            if end is not None:
+                where += ' AND year <= ?'
+                params.append(end)
+
+        last = after
+        while True:
+            rows = cur.execute(
+                    '{} WHERE {} AND rowid > ? ORDER BY rowid LIMIT ?'.format(query, where),
+                    params + [last, batch_size]).fetchall()
+            yield from self._decode(cur, rows, fields)
+            if len(rows) < batch_size:
+                break
+            last = rows[-1][0]
+        con.close()
+
+    def snapshots(self, session_id, years=None, fields=None):
+        return list(self.iter_snapshots(session_id, years=years, fields=fields))
+
+    def snapshot_at(self, session_id, year, fields=None):
+        """The latest snapshot of the session at or before `year`,
+        or `None` if there isn't one."""
         _, cur = self._con()
+        query, params = self._select(fields)
         rows = cur.execute(
-                'SELECT timestamp, session, snapshot FROM snapshots WHERE session == ?',
-                (session_id,)).fetchall()
-        return [{
-            'session_id': session,
-            'timestamp': timestamp,
-            'snapshot': json.loads(snapshot),
-        } for timestamp, session, snapshot in rows]
-
-    def sessions(self):
+                '{} WHERE session == ? AND year <= ? ORDER BY year DESC, rowid DESC LIMIT 1'.format(query),
+                params + [session_id, year]).fetchall()
+        return next(self._decode(cur, rows, fields), None)
+
+    def snapshots_since(self, after_id, limit=1000):
+        """Up to `limit` snapshots (across all sessions)
+        with ids greater than `after_id`, in id order."""
         _, cur = self._con()
+        query, params = self._select(None)
         rows = cur.execute(
-                'SELECT timestamp, session, version, useragent FROM sessions').fetchall()
-        return [{
-            'id': session,
-            'timestamp': timestamp,
-            'version': version,
-            'useragent': useragent,
-        } for timestamp, session, version, useragent in rows]
+                '{} WHERE rowid > ? ORDER BY rowid LIMIT ?'.format(query),
+                params + [after_id, limit]).fetchall()
+        return list(self._decode(cur, rows))
+
+    def sessions(self, ids=None, start=None, end=None):
+        """Sessions with their stats (from `session_stats`),
+        optionally only those started between the `start` and `end` datetimes."""
+        _, cur = self._con()
+        query = 'SELECT s.timestamp, s.session, s.version, s.useragent, \
+                    COALESCE(st.n_snapshots, 0), st.first_year, st.last_year, st.last_timestamp, \
+                    COALESCE(st.n_duplicates, 0) \
+                FROM sessions s LEFT JOIN session_stats st ON st.session == s.session'
+        where = []
+        params = []
+        if ids is not None:
+            ids = list(ids)
+            where.append('s.session IN ({})'.format(','.join('?' for _ in ids)))
+            params += ids
+        if start is not None:
+            where.append('CAST(s.timestamp AS real) >= ?')
+            params.append(start.replace(tzinfo=timezone.utc).timestamp())
+        if end is not None:
+            where.append('CAST(s.timestamp AS real) < ?')
+            params.append(end.replace(tzinfo=timezone.utc).timestamp())
+        if where:
+            query = '{} WHERE {}'.format(query, ' AND '.join(where))
+        rows = cur.execute(query, params).fetchall()
+        return [session_row(row) for row in rows]
+
+    def session_stats(self, ids):
+        """`{session_id: stats}` (the stats fields of `sessions`) for those of `ids`
+        with any, straight from `session_stats`, i.e. even if their session row is elsewhere."""
+        ids = list(ids)
+        con, cur = self._con()
+        rows = cur.execute('SELECT session, n_snapshots, first_year, last_year, last_timestamp, n_duplicates \
+                FROM session_stats WHERE session IN ({})'.format(','.join('?' for _ in ids)), ids).fetchall()
+        con.close()
+        return {session_id: dict(zip(STATS_FIELDS, stats)) for session_id, *stats in rows}
+
+    def page_sessions(self, limit=100, after=None, version=None, start=None, end=None, useragent=None):
+        """A page of up to `limit` sessions (as in `sessions`), newest first,
+        and the cursor for the next page (`None` if this is the last one).
+        `after` is the cursor from the previous page.
+        Sessions can be filtered by `version`, being started between
+        the `start` and `end` datetimes, and `useragent` (a substring).
+
+        Pages are keyed on `(timestamp, session)` rather than offsets,
+        so each page is a range scan of the `sessions_timestamp`
+        (or `sessions_version`) index however deep it is."""
+        where = []
+        params = []
+        if after is not None:
+            timestamp, session_id = parse_cursor(after)
+            where.append('(CAST(s.timestamp AS real), s.session) < (?, ?)')
+            params += [timestamp, session_id]
+        if version is not None:
+            where.append('s.version == ?')
+            params.append(version)
+        if start is not None:
+            where.append('CAST(s.timestamp AS real) >= ?')
+            params.append(start.replace(tzinfo=timezone.utc).timestamp())
+        if end is not None:
+            where.append('CAST(s.timestamp AS real) < ?')
+            params.append(end.replace(tzinfo=timezone.utc).timestamp())
+        if useragent is not None:
+            where.append("instr(s.useragent, ?) > 0")
+            params.append(useragent)
+
+        con, cur = self._con()
+        rows = cur.execute('SELECT s.timestamp, s.session, s.version, s.useragent, \
+                    COALESCE(st.n_snapshots, 0), st.first_year, st.last_year, st.last_timestamp, \
+                    COALESCE(st.n_duplicates, 0) \
+                FROM sessions s LEFT JOIN session_stats st ON st.session == s.session \
+                WHERE {} ORDER BY CAST(s.timestamp AS real) DESC, s.session DESC LIMIT ?'.format(
+                    ' AND '.join(where) or '1'), params + [limit]).fetchall()
+        con.close()
+        sessions = [session_row(row) for row in rows]
+        cursor = None
+        if len(sessions) == limit:
+            cursor = make_cursor(sessions[-1])
+        return sessions, cursor
+
+    def _where(self, conditions):
+        """SQL (and params) for `query` conditions"""
+        where = []
+        params = []
+        for col, op, value in conditions:
+            if col != 'year' and col not in FIELD_COLUMNS:
+                raise ValueError('Can only query on year or {}, not {}'.format(', '.join(FIELD_COLUMNS), col))
+            if op not in OPS:
+                raise ValueError('Unknown comparison: {}'.format(op))
+            where.append('{} {} ?'.format(col, op))
+            params.append(value)
+        return ' AND '.join(where) or '1', params
+
+    def query(self, *conditions, columns=('session', 'year'), limit=None):
+        """Snapshots matching all `conditions`, each a `(column, op, value)`
+        on `year` or one of the `FIELD_COLUMNS`, e.g.
+        `db.query(('year', '==', 2060), ('temperature', '>', 2))`.
+        Returns a dict of `columns` (any of `id`, `timestamp`, `session`,
+        `year` and the `FIELD_COLUMNS`) per snapshot.
+        The filtering happens in sqlite, on the indexed columns, so no snapshots are decoded."""
+        cols = ['id', 'timestamp', 'session', 'year', *FIELD_COLUMNS]
+        for col in columns:
+            if col not in cols:
+                raise ValueError('Unknown column: {}'.format(col))
+        where, params = self._where(conditions)
+        query = 'SELECT {} FROM snapshots WHERE {} ORDER BY id'.format(', '.join(columns), where)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        con, cur = self._con()
+        rows = cur.execute(query, params).fetchall()
+        con.close()
+        return [dict(zip(columns, row)) for row in rows]
+
+    def sessions_where(self, *conditions):
+        """Ids of the sessions with a snapshot matching all `conditions` (see `query`),
+        e.g. the sessions where the temperature was over 2 in 2060."""
+        where, params = self._where(conditions)
+        con, cur = self._con()
+        rows = cur.execute('SELECT DISTINCT session FROM snapshots WHERE {}'.format(where), params).fetchall()
+        con.close()
+        return [row[0] for row in rows]
+
+    def _rollup(self, fn, **kwargs):
+        con, cur = self._con()
+        try:
+            return fn(cur, **kwargs)
+        finally:
+            con.close()
+
+    def project_transitions(self, project=None, version=None):
+        """`{(project, from_status, to_status): count}`, from the rollups."""
+        return self._rollup(rollups.project_transitions, project=project, version=version)
+
+    def project_sessions(self, status='Active', version=None):
+        """`{project: number of sessions}` that reached `status`, from the rollups."""
+        return self._rollup(rollups.project_sessions, status=status, version=version)
+
+    def process_mix(self, version=None):
+        """`{(year bucket, process, mix share): count}`, from the rollups.
+        See `rollups.mean_mix` for the mean mix share per year bucket."""
+        return self._rollup(rollups.process_mix, version=version)
+
+    def years_reached(self, version=None):
+        """`{last year reached: number of sessions}`, from the rollups."""
+        return self._rollup(rollups.years_reached, version=version)
+
+    def rebuild_rollups(self, batch_size=100):
+        """Recompute the rollups from the snapshots. Returns the number of sessions.
+        This holds the write lock while it runs, so that
+        the rollups are consistent with the snapshots when it's done."""
+        con, cur = self._con()
+        con.execute('PRAGMA busy_timeout = 30000')
+        with con:
+            cur.execute('BEGIN IMMEDIATE')
+            rollups.clear(cur)
+            sessions = [row[0] for row in cur.execute('SELECT session FROM session_stats')]
+            for session_id in sessions:
+                rows = []
+                for s in self.iter_snapshots(session_id, fields=rollups.FIELDS, batch_size=batch_size):
+                    rows.append((session_id, s['snapshot'], s['weight']))
+                    if len(rows) >= batch_size:
+                        rollups.update(cur, rows)
+                        rows = []
+                rollups.update(cur, rows)
+        con.close()
+        return len(sessions)
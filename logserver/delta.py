@@ -0,0 +1,86 @@
+"""
+Structural JSON deltas.
+
+A delta is one of:
+
+- `{'=': value}`: replace with `value`
+- `{'d': {key: delta, ...}, 'x': [key, ...]}`: patch a dict,
+  applying a delta per changed key and removing the `x` keys
+- `{'l': {index: delta, ...}}`: patch a list of the same length
+
+Lists that change length are replaced outright.
+"""
+
+def diff(a, b):
+    """Delta that turns `a` into `b`, or `None` if they're equal."""
+    if isinstance(a, dict) and isinstance(b, dict):
+        changes = {}
+        for k, v in b.items():
+            if k in a:
+                d = diff(a[k], v)
+                if d is not None:
+                    changes[k] = d
+            else:
+                changes[k] = {'=': v}
+        removed = [k for k in a if k not in b]
+        if not changes and not removed:
+            return None
+        delta = {'d': changes}
+        if removed:
+            delta['x'] = removed
+        return delta
+
+    elif isinstance(a, list) and isinstance(b, list) and len(a) == len(b):
+        changes = {}
+        for i, (x, y) in enumerate(zip(a, b)):
+            d = diff(x, y)
+            if d is not None:
+                changes[str(i)] = d
+        if not changes:
+            return None
+        return {'l': changes}
+
+    # Note that `1 == 1.0` and `True == 1`, so compare types too
+    elif type(a) == type(b) and a == b:
+        return None
+    return {'=': b}
+
+def patch(a, delta):
+    """Apply `delta` to `a`. This modifies `a` in place
+    (where possible), so pass a copy if you need to keep `a`."""
+    if delta is None:
+        return a
+    if '=' in delta:
+        return delta['=']
+    elif 'd' in delta:
+        for k, d in delta['d'].items():
+            a[k] = patch(a.get(k), d)
+        for k in delta.get('x', []):
+            del a[k]
+        return a
+    elif 'l' in delta:
+        for i, d in delta['l'].items():
+            i = int(i)
+            a[i] = patch(a[i], d)
+        return a
+    raise ValueError('Unrecognized delta: {}'.format(delta))
+
+def subdelta(delta, path):
+    """The part of `delta` that applies to the value
+    at `path` (a list of dict keys), or `None` if it's unchanged."""
+    for i, key in enumerate(path):
+        if delta is None:
+            return None
+        elif '=' in delta:
+            value = delta['=']
+            for k in path[i:]:
+                value = value.get(k) if isinstance(value, dict) else None
+            return {'=': value}
+        elif 'd' in delta:
+            if key in delta.get('x', []):
+                return {'=': None}
+            delta = delta['d'].get(key)
+        else:
+            # Paths only go through dicts
+            return None
+    return delta
@@ -0,0 +1,149 @@
+"""
+Event frequencies in real play, to calibrate against the simulated ones.
+
+`engine/plot.py` counts how often each event happens per year across
+the runs of `engine/examples/simulate.rs` (its `event_dists`,
+`{event name: {year: count}}`). This computes the same from the telemetry:
+
+    python event_dists.py --db logs.db --out event_dists
+
+writes `event_dists/event_dists.json`, `{event name: {year: frequency}}`,
+where the frequency is the number of times the event happened in that year
+divided by the number of sessions that played that year. Simulated runs
+all play every year, so plot.py's counts divided by its `n_runs`
+are directly comparable.
+
+Snapshots carry the game's events so far (`events`, a list of
+`[event id, region id, event ref id]`), so the events that are new in a
+snapshot happened in the year of the session's previous snapshot
+(in one of the years since, if sampling dropped some). Events from before
+a session's first snapshot (e.g. it resumed a saved game) can't be placed
+and aren't counted, and a session counts as playing the years from its first
+snapshot's up to (not including) its last one's.
+
+Each run only reads the sessions started since the previous run
+(tracked in `state.json`, with the counts so far), once they're
+at least `--hours` old so they're over.
+"""
+
+import os
+import json
+import click
+from datetime import datetime, timedelta
+from collections import defaultdict
+from read import FIELDS
+from db import snapshot_year
+from partitions import open_database
+
+EVENTS = os.path.join(os.path.dirname(__file__), '..', 'assets', 'content', 'events.json')
+
+def event_names(path=EVENTS):
+    """`{event ref id or id: name}` from the game's content."""
+    with open(path) as f:
+        events = json.load(f)
+    names = {}
+    for id, ev in events.items():
+        names[ev['ref_id']] = ev['name']
+        names[int(id)] = ev['name']
+    return names
+
+def session_events(snapshots):
+    """`(first year, last year, [(year, event)])` of a session, where
+    each event is `[event id, region id, event ref id]` (see the module docstring).
+    The years are `None` if it has no snapshots with years and events."""
+    first = last = None
+    seen = None
+    events = []
+    for s in snapshots:
+        year = snapshot_year(s['snapshot'])
+        evs = s['snapshot'].get('events')
+        if not isinstance(year, int) or not isinstance(evs, list):
+            continue
+        # Otherwise it's the session's first snapshot, or it started a new game
+        if seen is not None and len(evs) >= seen:
+            events += [(last, ev) for ev in evs[seen:]]
+        seen = len(evs)
+        first = year if first is None else first
+        last = year
+    return first, last, events
+
+def event_name(ev, names):
+    if not isinstance(ev, list) or not ev:
+        return None
+    ref_id = ev[2] if len(ev) > 2 else None
+    return names.get(ref_id) or names.get(ev[0]) or str(ref_id or ev[0])
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'state.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'until': None, 'sessions': 0, 'counts': {}, 'played': {}}
+
+def save_json(out_dir, name, obj):
+    path = os.path.join(out_dir, name)
+    with open('{}.tmp'.format(path), 'w') as f:
+        json.dump(obj, f)
+    os.replace('{}.tmp'.format(path), path)
+
+def update(db, out_dir, hours=24, names=None):
+    """Count the events of the sessions started since the last run
+    and at least `hours` ago, and rewrite `event_dists.json`.
+    Returns the number of sessions read."""
+    os.makedirs(out_dir, exist_ok=True)
+    names = event_names() if names is None else names
+    state = load_state(out_dir)
+    counts = defaultdict(lambda: defaultdict(int))
+    for name, years in state['counts'].items():
+        counts[name].update({int(y): n for y, n in years.items()})
+    played = defaultdict(int, {int(y): n for y, n in state['played'].items()})
+
+    until = datetime.utcnow() - timedelta(hours=hours)
+    start = None if state['until'] is None else datetime.utcfromtimestamp(state['until'])
+    sessions = db.sessions(start=start, end=until)
+    for session in sessions:
+        if not session['n_snapshots']:
+            continue
+        first, last, events = session_events(
+                db.iter_snapshots(session['id'], fields=FIELDS['events']))
+        if first is None:
+            continue
+        for year in range(first, last):
+            played[year] += 1
+        for year, ev in events:
+            name = event_name(ev, names)
+            if name is not None:
+                counts[name][year] += 1
+
+    state = {
+        'until': (until - datetime(1970, 1, 1)).total_seconds(),
+        'sessions': state['sessions'] + len(sessions),
+        'counts': counts,
+        'played': played,
+    }
+    save_json(out_dir, 'event_dists.json', {
+        name: {year: n / played[year] for year, n in sorted(years.items()) if played[year]}
+        for name, years in sorted(counts.items())})
+    save_json(out_dir, 'state.json', state)
+    return len(sessions)
+
+def load(out_dir):
+    """`{event name: {year: frequency}}` as written by `update`,
+    with int years like plot.py's `event_dists`."""
+    with open(os.path.join(out_dir, 'event_dists.json')) as f:
+        return {name: {int(y): freq for y, freq in years.items()}
+                for name, years in json.load(f).items()}
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--out', 'out_dir', default='event_dists', help='Directory to write to')
+@click.option('--hours', default=24, help='Only read sessions started at least this many hours ago')
+@click.option('--full', is_flag=True, help='Recount all sessions instead of just new ones')
+def main(path, out_dir, hours, full):
+    if full and os.path.exists(os.path.join(out_dir, 'state.json')):
+        os.remove(os.path.join(out_dir, 'state.json'))
+    n = update(open_database(path), out_dir, hours=hours)
+    print('Read {} new sessions into {}'.format(n, out_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Exports snapshots to Parquet for analytics.
+
+Snapshots are flattened into three tables, each written as a
+dataset partitioned by game version and (UTC) date,
+e.g. `export/processes/version=abc123/date=2022-05-01/*.parquet`:
+
+- `world`: one row per snapshot, with the scalar `gameState.world` fields,
+  `political_capital`, CO2eq emissions (Gt) and output demand
+- `processes`: one row per process per snapshot, with its `mix_share`
+- `projects`: one row per project per snapshot, with its status, points and level
+
+Every row also has its snapshot's `weight` (see `sampling.py`).
+
+Each run only exports snapshots added since the last run
+(tracked in `state.json` in the export directory, per partition
+for a partitioned database). Snapshot ids are only unique
+within a partition, but a session's snapshots are all in one.
+
+The functions at the bottom are columnar versions of
+the `read.py` analyses that run on the exported data.
+"""
+
+import os
+import json
+import click
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from partitions import open_database, PartitionedDatabase
+from read import gtco2eq
+from datetime import datetime
+
+TABLES = ['world', 'processes', 'projects']
+PARTITIONS = ['version', 'date']
+
+# Column types. `pa.Table.from_pylist` would otherwise take the columns
+# (and their types) from each chunk's first row, but the `world` columns
+# vary by game version and state, and a field can be an int in one snapshot
+# and a float in the next. Other `world` columns are `FLOAT`.
+META = [('session', pa.string()), ('id', pa.int64()), ('version', pa.string()),
+        ('date', pa.string()), ('year', pa.int64()), ('weight', pa.int64())]
+COLUMNS = {
+    'world': META,
+    'processes': META + [('ref_id', pa.string()), ('name', pa.string()), ('mix_share', pa.int64())],
+    'projects': META + [('ref_id', pa.string()), ('name', pa.string()), ('status', pa.string()),
+        ('points', pa.int64()), ('level', pa.int64())],
+}
+FLOAT = pa.float64()
+
+def flatten(snapshot, version):
+    """Flatten a snapshot into rows for each table."""
+    state = snapshot['snapshot']['gameState']
+    world = state['world']
+    date = datetime.utcfromtimestamp(float(snapshot['timestamp'])).strftime('%Y-%m-%d')
+    meta = {
+        'session': snapshot['session_id'],
+        'id': snapshot['id'],
+        'version': version,
+        'date': date,
+        'year': world['year'],
+        'weight': snapshot['weight'],
+    }
+
+    world_row = dict(meta)
+    world_row.update({
+        k: v for k, v in world.items()
+        if isinstance(v, (int, float)) and not isinstance(v, bool)})
+    world_row['political_capital'] = state.get('political_capital')
+    world_row['emissions'] = gtco2eq(world)
+    for output, demand in state.get('output_demand', {}).items():
+        world_row['demand_{}'.format(output)] = demand
+
+    process_rows = [dict(meta,
+        ref_id=p['ref_id'],
+        name=p['name'],
+        mix_share=p['mix_share'],
+    ) for p in state['processes']]
+
+    project_rows = [dict(meta,
+        ref_id=p['ref_id'],
+        name=p['name'],
+        status=p['status'],
+        points=p['points'],
+        level=p['level'],
+    ) for p in state['projects']]
+
+    return {
+        'world': [world_row],
+        'processes': process_rows,
+        'projects': project_rows,
+    }
+
+def schema(table, rows):
+    """Schema for a chunk of a table's rows: its `COLUMNS`,
+    then any others (in the `world` table) in name order."""
+    columns = dict(COLUMNS[table])
+    extra = sorted({k for row in rows for k in row} - set(columns))
+    return pa.schema(list(columns.items()) + [(k, FLOAT) for k in extra])
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'state.json'), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'last_id': 0, 'runs': 0}
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, 'state.json')
+    with open('{}.tmp'.format(path), 'w') as f:
+        json.dump(state, f)
+    os.replace('{}.tmp'.format(path), path)
+
+def export(db, out_dir, chunk_size=1000):
+    """Export snapshots added since the last export to `out_dir`.
+    `db` can be a `Database` or a `PartitionedDatabase`."""
+    os.makedirs(out_dir, exist_ok=True)
+    state = load_state(out_dir)
+    state['runs'] += 1
+
+    if isinstance(db, PartitionedDatabase):
+        last_ids = state.setdefault('last_ids', {})
+        n = 0
+        for key, partition in db.partitions():
+            n += _export(partition, out_dir, state, last_ids, key,
+                    '{}-{}'.format(state['runs'], key), chunk_size)
+        return n
+    return _export(db, out_dir, state, state, 'last_id', state['runs'], chunk_size)
+
+def _export(db, out_dir, state, last_ids, key, prefix, chunk_size):
+    """Export the snapshots of a single database after `last_ids[key]`,
+    to files named starting with `prefix`."""
+    n = 0
+    while True:
+        snapshots = db.snapshots_since(last_ids.get(key, 0), limit=chunk_size)
+        if not snapshots:
+            break
+
+        versions = {s['id']: s['version'] for s in db.sessions(
+            {s['session_id'] for s in snapshots})}
+        rows = {table: [] for table in TABLES}
+        for s in snapshots:
+            try:
+                flat = flatten(s, versions.get(s['session_id']))
+            except (KeyError, TypeError, ValueError):
+                print('Skipping malformed snapshot', s['id'])
+                continue
+            for table, table_rows in flat.items():
+                rows[table] += table_rows
+
+        for table, table_rows in rows.items():
+            if not table_rows:
+                continue
+            pq.write_to_dataset(
+                    pa.Table.from_pylist(table_rows, schema=schema(table, table_rows)),
+                    os.path.join(out_dir, table),
+                    partition_cols=PARTITIONS,
+                    basename_template='{}-{}-{{i}}.parquet'.format(
+                        prefix, snapshots[0]['id']))
+
+        # Save progress after each chunk so
+        # an interrupted export picks up where it left off
+        last_ids[key] = snapshots[-1]['id']
+        save_state(out_dir, state)
+        n += len(snapshots)
+    return n
+
+def load(out_dir, table, session_id=None, version=None, columns=None):
+    """Load an exported table as a `pandas.DataFrame`, sorted by snapshot id.
+    Filters are pushed down so only the matching partitions/row groups are read."""
+    path = os.path.join(out_dir, table)
+    dataset = ds.dataset(path, format='parquet', partitioning='hive')
+    # Files can have different columns (see `COLUMNS`), so read with all of them
+    # (promoting ints to floats in files exported before `COLUMNS` was)
+    dataset = ds.dataset(path, format='parquet', partitioning='hive',
+            schema=pa.unify_schemas([dataset.schema] + [f.physical_schema for f in dataset.get_fragments()],
+                promote_options='permissive'))
+    filter = None
+    if session_id is not None:
+        filter = ds.field('session') == session_id
+    if version is not None:
+        cond = ds.field('version') == version
+        filter = cond if filter is None else filter & cond
+    if columns is not None:
+        columns = list({'id'} | set(columns))
+    df = dataset.to_table(columns=columns, filter=filter).to_pandas()
+    return df.sort_values('id', kind='stable')
+
+def emissions(out_dir, session_id):
+    df = load(out_dir, 'world', session_id, columns=['year', 'emissions'])
+    return df[['year', 'emissions']].to_dict('records')
+
+def electricity_demand(out_dir, session_id):
+    df = load(out_dir, 'world', session_id, columns=['year', 'demand_electricity'])
+    df['demand'] = df['demand_electricity'] * 1e-9
+    return df[['year', 'demand']].to_dict('records')
+
+def process_mix(out_dir, session_id):
+    df = load(out_dir, 'processes', session_id, columns=['name', 'mix_share'])
+    df = df[df['id'] == df['id'].max()]
+    return df[['name', 'mix_share']].to_dict('records')
+
+def project_timeline(out_dir, session_id):
+    df = load(out_dir, 'projects', session_id,
+            columns=['year', 'ref_id', 'status', 'points', 'level'])
+    timeline = {id: {'year': year}
+            for id, year in df.groupby('id', sort=True)['year'].first().items()}
+
+    # Only keep rows where an active project's
+    # (status, points, level) changed since its last active snapshot
+    df = df[df['status'] != 'Inactive']
+    prev = df.groupby('ref_id')[['status', 'points', 'level']].shift()
+    changed = (df[['status', 'points', 'level']] != prev).any(axis=1)
+    for row in df[changed].itertuples(index=False):
+        timeline[row.id][row.ref_id] = (row.status, row.points, row.level)
+    return list(timeline.values())
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--out', 'out_dir', default='export', help='Directory to export to')
+@click.option('--full', is_flag=True, help='Re-export everything instead of just new snapshots')
+def main(path, out_dir, full):
+    if full:
+        for table in TABLES:
+            shutil.rmtree(os.path.join(out_dir, table), ignore_errors=True)
+        if os.path.exists(os.path.join(out_dir, 'state.json')):
+            os.remove(os.path.join(out_dir, 'state.json'))
+    n = export(open_database(path), out_dir)
+    print('Exported {} snapshots to {}'.format(n, out_dir))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Live view of play as it happens, published as Server-Sent Events
+on `GET /live` (by both `main.py` and `asgi.py`), e.g.:
+
+    curl -N http://localhost:5000/live
+
+Every `LIVE_INTERVAL` seconds, each client gets an event whose data is JSON with:
+
+- `active_sessions`: sessions with a snapshot (or that started)
+  in the last `LIVE_WINDOW` seconds
+- `snapshots_per_minute`: snapshots received in the last minute
+- `years`: `{year bucket: active sessions}`, by their current year
+- `median_temperature`, `median_emissions` (Gt CO2eq): over the active
+  sessions' latest snapshots (`null` when there aren't any)
+
+These are kept in memory, updated as snapshots come in
+(whether or not sampling keeps them), and never touch the database.
+They're per server process.
+
+A stream from `main.py` holds a WSGI worker for as long as the client
+stays connected, so it only serves `LIVE_MAX_STREAMS` at a time
+(see `Live.stream`); `asgi.py` streams from its event loop, so it doesn't cap them.
+"""
+
+import json
+import threading
+from time import monotonic, sleep
+from statistics import median
+from collections import OrderedDict, deque
+from db import gtco2eq, snapshot_year
+
+# Width (in years) of the `years` buckets
+YEAR_BUCKET = 5
+
+class Live:
+    def __init__(self, window=300):
+        self.window = window
+        self._lock = threading.Lock()
+
+        # session_id -> (last seen, year, temperature, emissions), least recently seen first
+        self._sessions = OrderedDict()
+
+        # Arrival times of the snapshots in the last minute
+        self._arrivals = deque()
+
+        # (time, summary), so many clients don't each recompute it
+        self._summary = (None, None)
+
+        # Open `stream`s
+        self._streams = 0
+
+    def add_session(self, session_id):
+        with self._lock:
+            if session_id not in self._sessions:
+                self._sessions[session_id] = (monotonic(), None, None, None)
+
+    def add_snapshot(self, session_id, snapshot):
+        # Snapshots are whatever clients sent
+        state = snapshot.get('gameState') if isinstance(snapshot, dict) else None
+        world = state.get('world') if isinstance(state, dict) else None
+        if not isinstance(world, dict):
+            world = {}
+        try:
+            emissions = gtco2eq(world)
+        except (KeyError, TypeError):
+            emissions = None
+        now = monotonic()
+        with self._lock:
+            self._sessions[session_id] = (now, snapshot_year(snapshot), world.get('temperature'), emissions)
+            self._sessions.move_to_end(session_id)
+            self._arrivals.append(now)
+            self._prune(now)
+
+    def _prune(self, now):
+        while self._sessions:
+            session_id, (seen, *_) = next(iter(self._sessions.items()))
+            if seen >= now - self.window:
+                break
+            self._sessions.popitem(last=False)
+        while self._arrivals and self._arrivals[0] < now - 60:
+            self._arrivals.popleft()
+
+    def summary(self):
+        now = monotonic()
+        with self._lock:
+            at, summary = self._summary
+            if at is not None and now - at < 1:
+                return summary
+            self._prune(now)
+            sessions = list(self._sessions.values())
+            n_snapshots = len(self._arrivals)
+
+        years = {}
+        for _, year, _, _ in sessions:
+            if isinstance(year, int):
+                bucket = year - year % YEAR_BUCKET
+                years[bucket] = years.get(bucket, 0) + 1
+        temperatures = [t for _, _, t, _ in sessions if isinstance(t, (int, float))]
+        emissions = [e for _, _, _, e in sessions if isinstance(e, (int, float))]
+        summary = {
+            'active_sessions': len(sessions),
+            'snapshots_per_minute': n_snapshots,
+            'years': {str(bucket): n for bucket, n in sorted(years.items())},
+            'median_temperature': median(temperatures) if temperatures else None,
+            'median_emissions': median(emissions) if emissions else None,
+        }
+        with self._lock:
+            self._summary = (now, summary)
+        return summary
+
+    def event(self):
+        """The current summary as a Server-Sent Event"""
+        return 'data: {}\n\n'.format(json.dumps(self.summary()))
+
+    def stream(self, interval=1., max_streams=None):
+        """Server-Sent Events, every `interval` seconds, until closed.
+        `None` if there are already `max_streams` open."""
+        with self._lock:
+            if max_streams is not None and self._streams >= max_streams:
+                return None
+            self._streams += 1
+        return Stream(self, interval)
+
+class Stream:
+    """An iterator of `Live` events for a WSGI response,
+    which the server closes when the client disconnects."""
+    def __init__(self, live, interval):
+        self.live = live
+        self.interval = interval
+        self._first = True
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        if not self._first:
+            sleep(self.interval)
+        self._first = False
+        return self.live.event()
+
+    def close(self):
+        with self.live._lock:
+            if not self._closed:
+                self._closed = True
+                self.live._streams -= 1
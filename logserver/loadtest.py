@@ -0,0 +1,278 @@
+"""
+Load test for a running logserver, e.g.:
+
+    python main.py   # or: uvicorn asgi:app --port 5000
+    python loadtest.py --url http://localhost:5000 --sessions 200 --concurrency 32 --db logs.db
+
+Each simulated client starts a session and then sends one snapshot per year,
+evolving a state shaped like `sharing/data/example_game.json` as it goes
+(world stats drift, processes' mix shares and projects' statuses change
+now and then), so payloads and deltas look like real games.
+`--batch n` sends them `n` at a time to `/snapshots` instead.
+
+Reports p50/p95/p99 latency, throughput and the database's final size,
+and saves them as JSON (`--out`) to compare runs across changes.
+Doesn't need anything beyond `click` and the standard library.
+"""
+
+import os
+import gzip
+import json
+import time
+import click
+import random
+import sqlite3
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+from urllib.parse import urlparse
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), '..', 'sharing', 'data', 'example_game.json')
+
+STATUSES = ['Inactive', 'Building', 'Active', 'Halted', 'Finished']
+
+def evolve(state, rng):
+    """Advance a game state by a year, in place"""
+    world = state['world']
+    world['year'] += 1
+    for k in ['temperature', 'co2_emissions', 'ch4_emissions', 'n2o_emissions',
+            'contentedness', 'population', 'sea_level_rise']:
+        if isinstance(world.get(k), (int, float)):
+            world[k] *= 1 + rng.uniform(-0.05, 0.05)
+    for region in world['regions']:
+        region['outlook'] = rng.uniform(0, 10)
+    for p in state['processes']:
+        if rng.random() < 0.1:
+            p['mix_share'] = rng.randint(0, 20)
+    for p in state['projects']:
+        if rng.random() < 0.05:
+            p['status'] = rng.choice(STATUSES)
+            p['points'] = rng.randint(0, 5)
+    state['political_capital'] = rng.randint(0, 100)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def db_size(path):
+    """Size in bytes of a database (including what's still in its WAL),
+    or of a partitions directory"""
+    if os.path.isdir(path):
+        return sum(db_size(os.path.join(path, f)) for f in os.listdir(path) if f.endswith('.db'))
+    if not os.path.exists(path):
+        return 0
+    con = sqlite3.connect(path)
+    page_count, = con.execute('PRAGMA page_count').fetchone()
+    page_size, = con.execute('PRAGMA page_size').fetchone()
+    con.close()
+    return page_count * page_size
+
+class Client:
+    def __init__(self, url, compress):
+        url = urlparse(url)
+        self.host = url.hostname
+        self.port = url.port
+        self.compress = compress
+        self.con = http.client.HTTPConnection(self.host, self.port, timeout=60)
+
+    def post(self, path, data):
+        """`(status, seconds, bytes sent)`; status is `None` if the request failed"""
+        body = json.dumps(data).encode('utf8')
+        headers = {'Content-Type': 'application/json'}
+        # Only batch uploads can be compressed
+        if self.compress and path == '/snapshots':
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        start = time.perf_counter()
+        try:
+            self.con.request('POST', path, body, headers)
+            resp = self.con.getresponse()
+            resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            self.con.close()
+            status = None
+        return status, time.perf_counter() - start, len(body)
+
+class LoadTest:
+    def __init__(self, url, example, sessions, years, concurrency, rate, batch, compress, seed):
+        self.url = url
+        self.sessions = sessions
+        self.years = years
+        self.concurrency = concurrency
+        self.rate = rate
+        self.batch = batch
+        self.compress = compress
+        self.seed = seed
+        with open(example) as f:
+            self.example = f.read()
+
+        self._lock = threading.Lock()
+        self._next_session = 0
+        self._n_requests = 0
+
+        # path -> [(status, seconds, bytes, snapshots)]
+        self.results = {}
+
+    def _throttle(self):
+        """Wait for this request's slot to keep to `rate` requests/second overall"""
+        if not self.rate:
+            return
+        with self._lock:
+            slot = self.start + self._n_requests / self.rate
+            self._n_requests += 1
+        delay = slot - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _record(self, path, result, n_snapshots=0):
+        with self._lock:
+            self.results.setdefault(path, []).append((*result, n_snapshots))
+
+    def _session(self, client, i):
+        rng = random.Random('{}-{}'.format(self.seed, i))
+        session_id = 'loadtest-{}-{}'.format(self.seed, i)
+        state = json.loads(self.example)
+
+        self._throttle()
+        self._record('/session', client.post('/session', {
+            'session_id': session_id,
+            'version': 'loadtest',
+        }))
+
+        pending = []
+        for year in range(self.years):
+            evolve(state, rng)
+            # The example is of a finished game
+            state['game_over'] = year == self.years - 1
+            snapshot = {'gameState': state, 'events': []}
+            if not self.batch:
+                self._throttle()
+                self._record('/snapshot', client.post('/snapshot', {
+                    'session_id': session_id,
+                    'snapshot': snapshot,
+                }), 1)
+                continue
+
+            # Serialize now, since the state keeps changing
+            pending.append(json.loads(json.dumps({'session_id': session_id, 'snapshot': snapshot})))
+            if len(pending) == self.batch:
+                self._throttle()
+                self._record('/snapshots', client.post('/snapshots', pending), len(pending))
+                pending = []
+        if pending:
+            self._throttle()
+            self._record('/snapshots', client.post('/snapshots', pending), len(pending))
+
+    def _worker(self):
+        client = Client(self.url, self.compress)
+        while True:
+            with self._lock:
+                i = self._next_session
+                self._next_session += 1
+            if i >= self.sessions:
+                break
+            self._session(client, i)
+
+    def run(self):
+        self.start = time.perf_counter()
+        threads = [threading.Thread(target=self._worker) for _ in range(self.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.elapsed = time.perf_counter() - self.start
+
+    def report(self):
+        routes = {}
+        n_requests = 0
+        n_snapshots = 0
+        for path, results in sorted(self.results.items()):
+            ok = [secs for status, secs, _, _ in results if status == 200]
+            statuses = {}
+            for status, _, _, _ in results:
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+            routes[path] = {
+                'requests': len(results),
+                'statuses': statuses,
+                'bytes': sum(n for _, _, n, _ in results),
+                'latency_ms': {p: None if secs is None else secs * 1e3 for p, secs in [
+                    ('p50', percentile(ok, 50)),
+                    ('p95', percentile(ok, 95)),
+                    ('p99', percentile(ok, 99)),
+                    ('max', percentile(ok, 100)),
+                ]},
+            }
+            n_requests += len(results)
+            n_snapshots += sum(n for status, _, _, n in results if status == 200)
+        return {
+            'elapsed': self.elapsed,
+            'requests_per_second': n_requests / self.elapsed,
+            'snapshots_per_second': n_snapshots / self.elapsed,
+            'routes': routes,
+        }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@click.command()
+@click.option('--url', default='http://localhost:5000', help='Server to test')
+@click.option('--sessions', default=100, help='Number of sessions to simulate')
+@click.option('--years', default=80, help='Snapshots per session')
+@click.option('--concurrency', default=16, help='Number of concurrent clients')
+@click.option('--rate', default=0., help='Max requests per second overall (0 for no limit)')
+@click.option('--batch', default=0, help='Upload snapshots this many at a time to /snapshots (0 to use /snapshot)')
+@click.option('--gzip', 'compress', is_flag=True, help='gzip request bodies')
+@click.option('--db', 'db_path', default=None, help="Path to the server's database (or partitions directory), to report its size")
+@click.option('--wait', default=2., help='Seconds to wait for queued writes before measuring the database')
+@click.option('--example', default=EXAMPLE, help='Game state to start sessions from')
+@click.option('--seed', default=0, help='Random seed (also used in session ids)')
+@click.option('--label', default=None, help='Label for this run in the results')
+@click.option('--out', default=None, help='Where to save the results (default loadtest-<time>.json)')
+def main(url, sessions, years, concurrency, rate, batch, compress, db_path, wait, example, seed, label, out):
+    test = LoadTest(url, example, sessions, years, concurrency, rate, batch, compress, seed)
+    size_before = db_size(db_path) if db_path else None
+
+    print('Simulating {} sessions of {} years with {} clients...'.format(sessions, years, concurrency))
+    test.run()
+    results = test.report()
+
+    if db_path:
+        time.sleep(wait)
+        results['db_bytes'] = db_size(db_path)
+        results['db_bytes_added'] = results['db_bytes'] - size_before
+
+    results = {
+        'label': label,
+        'commit': git_commit(),
+        'time': datetime.utcnow().isoformat(),
+        'config': {
+            'url': url, 'sessions': sessions, 'years': years,
+            'concurrency': concurrency, 'rate': rate, 'batch': batch, 'gzip': compress, 'seed': seed,
+        },
+        **results,
+    }
+
+    print('{:.1f}s, {:.0f} requests/s, {:.0f} snapshots/s'.format(
+        results['elapsed'], results['requests_per_second'], results['snapshots_per_second']))
+    for path, r in results['routes'].items():
+        lat = r['latency_ms']
+        print('  {}: {} requests {}, p50 {}ms, p95 {}ms, p99 {}ms'.format(path, r['requests'], r['statuses'],
+            *['{:.1f}'.format(lat[p]) if lat[p] is not None else '-' for p in ['p50', 'p95', 'p99']]))
+    if db_path:
+        print('Database: {:.1f}MB ({:+.1f}MB)'.format(results['db_bytes'] / 1e6, results['db_bytes_added'] / 1e6))
+
+    out = out or 'loadtest-{}.json'.format(datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Saved results to', out)
+
+if __name__ == '__main__':
+    main()
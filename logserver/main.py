@@ -1,7 +1,16 @@
+import atexit
 import config
-from db import Database
+import metrics
+from time import perf_counter
+from shards import ShardedDatabase
+import api
+import batch
+import sampling
+from server import db, sampler, live, WRITER, LIVE_INTERVAL, LIVE_MAX_STREAMS, \
+        MAX_BATCH_BYTES, MAX_BATCH_RECORDS, MAX_PAGE_SIZE
+from writer import Writer, QueueFull
 from flask_cors import CORS
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 
@@ -12,20 +21,68 @@ sentry_sdk.init(
     # Set traces_sample_rate to 1.0 to capture 100%
     # of transactions for performance monitoring.
     # We recommend adjusting this value in production.
-    traces_sample_rate=1.0
+    # Exact counts are in `/metrics` regardless.
+    traces_sample_rate=getattr(config, 'TRACES_SAMPLE_RATE', 1.0)
 )
 
-db = Database('logs.db')
+if isinstance(db, ShardedDatabase):
+    # Registered before the writer's, so it runs after it
+    atexit.register(db.close)
+
+# Write-behind ingestion: requests enqueue and
+# a background thread writes in batches.
+# Set `WRITE_BEHIND = False` in `config.py` to write synchronously.
+if getattr(config, 'WRITE_BEHIND', True):
+    writer = Writer(db, **WRITER)
+    atexit.register(writer.close)
+    metrics.QUEUE_DEPTH.set_function(writer.depth)
+else:
+    writer = db
 
 app = Flask(__name__)
 CORS(app)
 
+def route():
+    """The route pattern for metrics, so they're
+    not labelled per session id (or per bad path)"""
+    return request.url_rule.rule if request.url_rule else 'unknown'
+
+@app.before_request
+def start_timer():
+    g.start = perf_counter()
+
+@app.after_request
+def record_request(response):
+    metrics.REQUESTS.inc(route(), response.status_code)
+    metrics.REQUEST_SECONDS.observe(perf_counter() - g.start, route())
+    if request.method == 'POST':
+        metrics.REQUEST_BYTES.observe(request.content_length or 0, route())
+    return response
+
+@app.teardown_request
+def record_error(e):
+    if e is not None:
+        metrics.ERRORS.inc(route(), type(e).__name__)
+
+@app.errorhandler(QueueFull)
+def queue_full(e):
+    metrics.ERRORS.inc(route(), type(e).__name__)
+    # Tell clients to back off and retry later
+    return jsonify(success=False, error='busy'), 503, {'Retry-After': '5'}
+
+@app.errorhandler(batch.BadBatch)
+@app.errorhandler(api.BadQuery)
+def bad_request(e):
+    metrics.ERRORS.inc(route(), type(e).__name__)
+    return jsonify(success=False, error=str(e)), e.status
+
 @app.route('/session', methods=['POST'])
 def session():
     if request.method == 'POST':
         data = request.get_json()
         ua = request.headers.get('User-Agent')
-        db.add_session(data['session_id'], data['version'], ua)
+        writer.add_session(data['session_id'], data['version'], ua)
+        live.add_session(data['session_id'])
         return jsonify(success=True)
     return jsonify(success=False)
 
@@ -33,10 +90,48 @@ def session():
 def snapshot():
     if request.method == 'POST':
         data = request.get_json()
-        db.add_snapshot(data['session_id'], data['snapshot'])
+        live.add_snapshot(data['session_id'], data['snapshot'])
+        weight = sampler.sample(data['session_id'], data['snapshot'])
+        if weight is not None:
+            writer.add_snapshot(data['session_id'], data['snapshot'], weight)
         return jsonify(success=True)
     return jsonify(success=False)
 
+@app.route('/snapshots', methods=['POST'])
+def snapshots():
+    if request.method == 'POST':
+        rows, valid = batch.parse(
+                request.get_data(),
+                request.headers.get('Content-Encoding'),
+                MAX_BATCH_BYTES, MAX_BATCH_RECORDS)
+        for session_id, snapshot in rows:
+            live.add_snapshot(session_id, snapshot)
+        rows, keep = sampler.sample_batch(rows)
+        accepted = writer.add_snapshots(rows) if rows else []
+        return jsonify(success=True, accepted=batch.results(valid, sampling.results(keep, accepted)))
+    return jsonify(success=False)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
+
+@app.route('/live', methods=['GET'])
+def live_events():
+    stream = live.stream(LIVE_INTERVAL, LIVE_MAX_STREAMS)
+    if stream is None:
+        metrics.ERRORS.inc(route(), 'TooManyStreams')
+        return jsonify(success=False, error='busy'), 503, {'Retry-After': '5'}
+    return Response(stream, mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'})
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+    return jsonify(api.list_sessions(db, request.args, MAX_PAGE_SIZE))
+
+@app.route('/sessions/<session_id>/snapshots', methods=['GET'])
+def session_snapshots(session_id):
+    return jsonify(api.session_snapshots(db, session_id, request.args, MAX_PAGE_SIZE))
+
 
 if __name__ == '__main__':
-    app.run()
\ No newline at end of file
+    app.run()
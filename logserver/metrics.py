@@ -0,0 +1,161 @@
+"""
+Ingest metrics, served at `GET /metrics` in Prometheus' text format.
+
+These are exact counts kept in-process (per server process),
+independent of how many requests Sentry samples for tracing.
+"""
+
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets
+BYTES_BUCKETS = [2**i for i in range(10, 27, 2)]   # 1KB to 64MB
+SECONDS_BUCKETS = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(k,
+        str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for k, v in pairs))
+
+def _value(v):
+    return repr(float(v)) if v != float('inf') else '+Inf'
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, labels, _value(value)))
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, *labels, n=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, _labels(self.labels, k), v) for k, v in sorted(values.items())]
+
+class Gauge(Metric):
+    """A value read when the metrics are rendered, from `set_function`."""
+    type = 'gauge'
+
+    def __init__(self, name, help):
+        super().__init__(name, help)
+        self._fn = None
+
+    def set_function(self, fn):
+        self._fn = fn
+
+    def samples(self):
+        if self._fn is None:
+            return []
+        return [(self.name, '', self._fn())]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = buckets + [float('inf')]
+
+        # labels -> [count per bucket (not cumulative), sum, count]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    v[0][i] += 1
+                    break
+            v[1] += value
+            v[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = {k: (list(b), s, n) for k, (b, s, n) in self._values.items()}
+        samples = []
+        for k, (buckets, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n
+                samples.append(('{}_bucket'.format(self.name),
+                    _labels(self.labels, k, [('le', _value(bound))]), cumulative))
+            samples.append(('{}_sum'.format(self.name), _labels(self.labels, k), total))
+            samples.append(('{}_count'.format(self.name), _labels(self.labels, k), count))
+        return samples
+
+REGISTRY = []
+
+REQUESTS = Counter('logserver_requests_total',
+        'Requests handled, by route and status', ['route', 'status'])
+ERRORS = Counter('logserver_errors_total',
+        'Requests that failed, by route and error', ['route', 'error'])
+REQUEST_BYTES = Histogram('logserver_request_bytes',
+        'Request body sizes (as sent, before decompression)', BYTES_BUCKETS, ['route'])
+REQUEST_SECONDS = Histogram('logserver_request_seconds',
+        'Time to handle requests', SECONDS_BUCKETS, ['route'])
+INSERT_SECONDS = Histogram('logserver_insert_seconds',
+        'Time to insert the rows of a write transaction', SECONDS_BUCKETS)
+COMMIT_SECONDS = Histogram('logserver_commit_seconds',
+        'Time to commit a write transaction', SECONDS_BUCKETS)
+ROWS_WRITTEN = Counter('logserver_rows_written_total',
+        'Rows written, by table', ['table'])
+DUPLICATES = Counter('logserver_duplicate_snapshots_total',
+        'Snapshots skipped as copies of one already in their session')
+WRITE_ERRORS = Counter('logserver_write_errors_total',
+        'Queued writes that failed', ['kind'])
+QUEUE_DEPTH = Gauge('logserver_queue_depth',
+        'Writes waiting in the write-behind queue')
+MERGED = Counter('logserver_merged_snapshots_total',
+        'Snapshots merged from shards into the main database (see `shards.py`)')
+MERGE_SECONDS = Histogram('logserver_merge_seconds',
+        'Time to merge shards into the main database', SECONDS_BUCKETS)
+FAILED_SHARDS = Counter('logserver_failed_shards_total',
+        'Shards set aside because they couldn\'t be merged (see `shards.py`)')
+SAMPLED = Counter('logserver_snapshots_sampled_total',
+        'Snapshots kept or dropped by sampling', ['decision'])
+SAMPLING_INTERVAL = Gauge('logserver_sampling_interval',
+        'Years between the mid-game snapshots being kept (1 when not thinning)')
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,259 @@
+"""
+Upgrades `logs.db` to the latest schema (`db.SCHEMA_VERSION`)
+while the server keeps running.
+
+Each migration does its heavy lifting in small chunks,
+each in its own short transaction, so the server only
+ever waits on the write lock for one chunk at a time.
+Migrations are resumable: if one is interrupted, just run this again.
+"""
+
+import time
+import click
+import sqlite3
+from db import Database, SCHEMA_VERSION, COLUMNS, FIELD_COLUMNS, field_columns
+
+def connect(path):
+    # Autocommit mode so we control transactions explicitly
+    con = sqlite3.connect(path, isolation_level=None, timeout=30)
+    con.execute('PRAGMA journal_mode=WAL')
+    return con
+
+def chunked(con, stmt, params, chunk_size, pause):
+    """Run `stmt` in its own transaction until it stops changing rows.
+    `stmt` should process at most `chunk_size` rows per run."""
+    total = 0
+    while True:
+        con.execute('BEGIN IMMEDIATE')
+        n = con.execute(stmt, params).rowcount
+        con.execute('COMMIT')
+        total += n
+        print('  {} rows'.format(total), end='\r')
+        if n < chunk_size:
+            break
+        time.sleep(pause)
+    print()
+
+def migrate_v1(con, chunk_size, pause):
+    """Rebuild `snapshots` with an autoincrement `id` key
+    (instead of `timestamp`, which can collide),
+    index it on `(session, timestamp)`, and backfill `sessions.n_snapshots`.
+    Existing rowids are kept as ids so that `base` references stay valid."""
+    cols = [row[1] for row in con.execute('PRAGMA table_info(snapshots)')]
+    if 'id' not in cols:
+        # Including the columns from later versions, which the server
+        # adds in place and writes to (e.g. `dict` for compressed rows)
+        # while this runs, and which later migrations fill in
+        later = [(col, typ) for col, typ in COLUMNS['snapshots'] if col != 'year']
+        con.execute('CREATE TABLE IF NOT EXISTS snapshots_v1 \
+                (id integer primary key autoincrement,\
+                timestamp text not null,\
+                session text not null,\
+                snapshot json not null,\
+                year integer,\
+                {})'.format(', '.join('{} {}'.format(col, typ) for col, typ in later)))
+        con.execute('CREATE INDEX IF NOT EXISTS snapshots_v1_session ON snapshots_v1(session, timestamp)')
+
+        # Older keyframes may not have their year set;
+        # those are full snapshots so we can pull it out in sqlite
+        later = ', '.join(col for col, _ in later)
+        copy = "INSERT INTO snapshots_v1(id, timestamp, session, snapshot, year, {later}) \
+                SELECT rowid, timestamp, session, snapshot, \
+                    COALESCE(year, json_extract(snapshot, '$.gameState.world.year')), {later} \
+                FROM snapshots \
+                WHERE rowid > (SELECT COALESCE(MAX(id), 0) FROM snapshots_v1) \
+                ORDER BY rowid".format(later=later)
+
+        print('Copying snapshots...')
+        chunked(con, '{} LIMIT {}'.format(copy, chunk_size), (), chunk_size, pause)
+
+        # Copy anything written in the meantime and swap the tables
+        con.execute('BEGIN IMMEDIATE')
+        con.execute(copy)
+        con.execute('DROP TABLE snapshots')
+        con.execute('ALTER TABLE snapshots_v1 RENAME TO snapshots')
+        con.execute('DROP INDEX snapshots_v1_session')
+        con.execute('CREATE INDEX snapshots_session ON snapshots(session, timestamp)')
+        con.execute('COMMIT')
+
+    cols = [row[1] for row in con.execute('PRAGMA table_info(sessions)')]
+    if 'n_snapshots' not in cols:
+        con.execute('ALTER TABLE sessions ADD COLUMN n_snapshots integer not null default 0')
+
+    print('Counting snapshots per session...')
+    last = 0
+    while True:
+        con.execute('BEGIN IMMEDIATE')
+        ids = [row[0] for row in con.execute(
+            'SELECT rowid FROM sessions WHERE rowid > ? ORDER BY rowid LIMIT ?',
+            (last, chunk_size))]
+        if ids:
+            con.execute('UPDATE sessions \
+                    SET n_snapshots = (SELECT COUNT(*) FROM snapshots WHERE snapshots.session == sessions.session) \
+                    WHERE rowid BETWEEN ? AND ?', (ids[0], ids[-1]))
+        con.execute('COMMIT')
+        if len(ids) < chunk_size:
+            break
+        last = ids[-1]
+        time.sleep(pause)
+
+def migrate_v2(con, chunk_size, pause):
+    """Backfill `session_stats` (which replaces `sessions.n_snapshots`)."""
+    con.execute('CREATE TABLE IF NOT EXISTS session_stats \
+            (session text primary key,\
+            version text,\
+            n_snapshots integer not null default 0,\
+            first_year integer,\
+            last_year integer,\
+            last_timestamp real)')
+
+    # Each chunk recomputes the stats for its sessions from scratch,
+    # in the same transaction, so it's consistent with concurrent inserts
+    print('Computing session stats...')
+    last = ''
+    n = 0
+    while True:
+        con.execute('BEGIN IMMEDIATE')
+        ids = [row[0] for row in con.execute(
+            'SELECT DISTINCT session FROM snapshots WHERE session > ? ORDER BY session LIMIT ?',
+            (last, chunk_size))]
+        if ids:
+            # Leaving `n_duplicates`, which the server may already be counting
+            con.execute('INSERT INTO session_stats \
+                        (session, version, n_snapshots, first_year, last_year, last_timestamp) \
+                    SELECT sn.session, (SELECT version FROM sessions WHERE session == sn.session), \
+                        COUNT(*), MIN(sn.year), MAX(sn.year), MAX(CAST(sn.timestamp AS real)) \
+                    FROM snapshots sn WHERE sn.session BETWEEN ? AND ? GROUP BY sn.session \
+                    ON CONFLICT(session) DO UPDATE SET \
+                        version = excluded.version, \
+                        n_snapshots = excluded.n_snapshots, \
+                        first_year = excluded.first_year, \
+                        last_year = excluded.last_year, \
+                        last_timestamp = excluded.last_timestamp',
+                    (ids[0], ids[-1]))
+        con.execute('COMMIT')
+        n += len(ids)
+        print('  {} sessions'.format(n), end='\r')
+        if len(ids) < chunk_size:
+            break
+        last = ids[-1]
+        time.sleep(pause)
+    print()
+
+    # DROP COLUMN needs sqlite 3.35+; on older versions it's just left unused
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        cols = [row[1] for row in con.execute('PRAGMA table_info(sessions)')]
+        if 'n_snapshots' in cols:
+            con.execute('ALTER TABLE sessions DROP COLUMN n_snapshots')
+
+def migrate_v3(con, chunk_size, pause):
+    """Backfill the rollups (see `rollups.py`). Their tables were
+    created when the server started, and it has been keeping them up to date
+    since, but they can only be made consistent by rebuilding them in one go."""
+    print('Rebuilding rollups...')
+    db = Database(con.execute('PRAGMA database_list').fetchone()[2])
+    print('  {} sessions'.format(db.rebuild_rollups()))
+
+def migrate_v4(con, chunk_size, pause):
+    """Backfill the `FIELD_COLUMNS` of `snapshots` and index them.
+    Most rows are deltas, so this has to rebuild the snapshots in Python.
+    Each chunk covers whole sessions, and rewrites their values
+    from scratch in the same transaction, so it's safe to re-run."""
+    db = Database(con.execute('PRAGMA database_list').fetchone()[2])
+    fields = ['gameState.world', 'gameState.political_capital']
+    update = 'UPDATE snapshots SET {} WHERE id == ?'.format(
+            ', '.join('{} = ?'.format(col) for col in FIELD_COLUMNS))
+
+    print('Filling in snapshot columns...')
+    last = ''
+    n = 0
+    while True:
+        con.execute('BEGIN IMMEDIATE')
+        rows = []
+        while len(rows) < chunk_size:
+            row = con.execute('SELECT session FROM session_stats WHERE session > ? ORDER BY session LIMIT 1',
+                    (last,)).fetchone()
+            if row is None:
+                break
+            last, = row
+            rows += [(*field_columns(s['snapshot']), s['id'])
+                    for s in db.iter_snapshots(last, fields=fields)]
+        con.executemany(update, rows)
+        con.execute('COMMIT')
+        n += len(rows)
+        print('  {} rows'.format(n), end='\r')
+        if row is None:
+            break
+        time.sleep(pause)
+    print()
+
+    print('Indexing...')
+    for col in FIELD_COLUMNS:
+        con.execute('CREATE INDEX IF NOT EXISTS snapshots_{col} ON snapshots(year, {col})'.format(col=col))
+
+def migrate_v5(con, chunk_size, pause):
+    """Nothing to backfill: `dictionaries` and `snapshots.dict`
+    are added in place, and existing rows stay uncompressed
+    (`retention.py --compress` compresses the sessions it downsamples)."""
+    pass
+
+def migrate_v6(con, chunk_size, pause):
+    """Index `sessions` for paging through them (see `Database.page_sessions`)."""
+    print('Indexing sessions...')
+    con.execute('CREATE INDEX IF NOT EXISTS sessions_timestamp ON sessions(CAST(timestamp AS real), session)')
+    con.execute('CREATE INDEX IF NOT EXISTS sessions_version ON sessions(version, CAST(timestamp AS real), session)')
+
+def migrate_v7(con, chunk_size, pause):
+    """Nothing to backfill: `snapshots.weight` is added in place
+    (and carried over if `migrate_v1` rebuilds the table after),
+    and existing rows (where it's null) are read as having a weight of 1."""
+    pass
+
+def migrate_v8(con, chunk_size, pause):
+    """Index `snapshots.hash` (added in place) for skipping resent snapshots.
+    Older rows have no hash: only copies of snapshots sent before upgrading
+    can get past it, and sessions that old are long over."""
+    print('Indexing snapshot hashes...')
+    con.execute('CREATE INDEX IF NOT EXISTS snapshots_hash ON snapshots(session, hash)')
+
+def migrate_v9(con, chunk_size, pause):
+    """Nothing to backfill: `content_templates` and `snapshots.content`
+    are added in place (and `content` is carried over if `migrate_v1`
+    rebuilds the table after), and existing rows stay as they are."""
+    pass
+
+MIGRATIONS = {
+    1: migrate_v1,
+    2: migrate_v2,
+    3: migrate_v3,
+    4: migrate_v4,
+    5: migrate_v5,
+    6: migrate_v6,
+    7: migrate_v7,
+    8: migrate_v8,
+    9: migrate_v9,
+}
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database')
+@click.option('--chunk_size', default=5000, help='Rows per transaction')
+@click.option('--pause', default=0.05, help='Seconds to wait between chunks')
+def main(path, chunk_size, pause):
+    # Make sure the database exists and has
+    # the columns that can be added in place
+    Database(path)
+
+    con = connect(path)
+    version, = con.execute('PRAGMA user_version').fetchone()
+    if version >= SCHEMA_VERSION:
+        print('Already at schema version', version)
+        return
+
+    for v in range(version + 1, SCHEMA_VERSION + 1):
+        print('Migrating to schema version', v)
+        MIGRATIONS[v](con, chunk_size, pause)
+        con.execute('PRAGMA user_version = {}'.format(v))
+    print('Done')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+Time-partitioned telemetry databases.
+
+`PartitionedDatabase` has the same interface as `db.Database`
+but spreads sessions across one database file per day or per week
+(e.g. `logs/2022-05-01.db` or `logs/2022-W18.db`), so each file stays small
+and old ones can be downsampled, vacuumed, backed up or dropped on their own.
+
+A session's snapshots all go into the partition for the day/week
+the session started in, so a session is never split across files.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict, Counter
+from datetime import datetime, timedelta
+from db import Database, now, make_cursor, parse_cursor
+
+PERIODS = {
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+
+# How many sessions to remember the partitions of
+SESSION_CACHE_SIZE = 100000
+
+def partition_key(timestamp, period):
+    dt = datetime.utcfromtimestamp(timestamp)
+    if period == 'day':
+        return dt.strftime('%Y-%m-%d')
+    elif period == 'week':
+        return dt.strftime('%G-W%V')
+    raise ValueError('Unknown partition period: {}'.format(period))
+
+def partition_range(key):
+    """The `(start, end)` datetimes covered by a partition."""
+    if re.match(r'^\d{4}-W\d{2}$', key):
+        start = datetime.strptime('{}-1'.format(key), '%G-W%V-%u')
+        return start, start + PERIODS['week']
+    start = datetime.strptime(key, '%Y-%m-%d')
+    return start, start + PERIODS['day']
+
+def open_database(path, **kwargs):
+    """A `PartitionedDatabase` if `path` is a directory, otherwise a `Database`."""
+    if os.path.isdir(path):
+        return PartitionedDatabase(path, **kwargs)
+    return Database(path, **kwargs)
+
+class Connections:
+    """The writer connections for a `PartitionedDatabase`,
+    opened as the writer needs them. Only the most recently
+    used few are kept open, since writes go to recent partitions."""
+    def __init__(self, db, max_open=4):
+        self.db = db
+        self.max_open = max_open
+        self.cons = OrderedDict()
+
+    def get(self, key):
+        if key not in self.cons:
+            self.cons[key] = self.db.partition(key).writer_con()
+            while len(self.cons) > self.max_open:
+                _, con = self.cons.popitem(last=False)
+                con.close()
+        self.cons.move_to_end(key)
+        return self.cons[key]
+
+    def close(self):
+        for con in self.cons.values():
+            con.close()
+        self.cons = OrderedDict()
+
+class PartitionedDatabase:
+    def __init__(self, path, period='day', keyframe_interval=20, lookback=2, **kwargs):
+        """`lookback` is how many periods back to look for
+        a session's partition before starting it in the current one.
+        Other keyword arguments (e.g. `compress`) are passed on to each `Database`."""
+        self.path = path
+        self.period = period
+        self.keyframe_interval = keyframe_interval
+        self.kwargs = kwargs
+        self.lookback = lookback
+        self._partitions = {}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def keys(self, start=None, end=None):
+        """Keys of the existing partitions overlapping
+        the `start` and `end` datetimes (either can be `None`), oldest first."""
+        keys = []
+        for fname in os.listdir(self.path):
+            key, ext = os.path.splitext(fname)
+            if ext != '.db':
+                continue
+            try:
+                p_start, p_end = partition_range(key)
+            except ValueError:
+                continue
+            if (start is None or p_end > start) and (end is None or p_start <= end):
+                keys.append((p_start, key))
+        return [key for _, key in sorted(keys)]
+
+    def partition(self, key):
+        with self._lock:
+            db = self._partitions.get(key)
+            if db is not None:
+                return db
+            keys = self.keys()
+            db = self._partitions[key] = Database(
+                    os.path.join(self.path, '{}.db'.format(key)),
+                    keyframe_interval=self.keyframe_interval, **self.kwargs)
+
+        # New partitions start out with the latest
+        # compression dictionary of the partition before them
+        if db.compress and db.latest_dictionary() is None:
+            prev = [k for k in keys if k != key and partition_range(k) < partition_range(key)]
+            if prev:
+                dictionary = self.partition(prev[-1]).latest_dictionary()
+                if dictionary is not None:
+                    db.add_dictionary(dictionary[1])
+        return db
+
+    def partitions(self, start=None, end=None):
+        return [(key, self.partition(key)) for key in self.keys(start, end)]
+
+    def _remember(self, session_id, key):
+        with self._lock:
+            self._sessions[session_id] = key
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > SESSION_CACHE_SIZE:
+                self._sessions.popitem(last=False)
+
+    def _locate(self, session_id, timestamp):
+        """The key of the partition to write the session to."""
+        key = self._sessions.get(session_id)
+        if key is not None:
+            return key
+
+        # Look for the session in the recent partitions,
+        # in case it started in an earlier period
+        key = partition_key(timestamp, self.period)
+        for i in range(self.lookback + 1):
+            k = partition_key(timestamp - (PERIODS[self.period] * i).total_seconds(), self.period)
+            if os.path.exists(os.path.join(self.path, '{}.db'.format(k))) \
+                    and self.partition(k).has_session(session_id):
+                key = k
+                break
+        self._remember(session_id, key)
+        return key
+
+    def find(self, session_id):
+        """The partition the session is in, or `None`."""
+        key = self._sessions.get(session_id)
+        if key is not None:
+            return self.partition(key)
+        for key in reversed(self.keys()):
+            db = self.partition(key)
+            if db.has_session(session_id):
+                self._remember(session_id, key)
+                return db
+        return None
+
+    def writer_con(self):
+        return Connections(self, max_open=self.lookback + 2)
+
+    def add_session(self, session_id, version, user_agent):
+        cons = self.writer_con()
+        try:
+            self.write(cons, [(now(), session_id, version, user_agent)], [])
+        finally:
+            cons.close()
+
+    def add_snapshot(self, session_id, snapshot, weight=1):
+        cons = self.writer_con()
+        try:
+            self.write(cons, [], [(now(), session_id, snapshot, weight)])
+        finally:
+            cons.close()
+
+    def add_snapshots(self, rows):
+        cons = self.writer_con()
+        timestamp = now()
+        try:
+            return self.write_snapshot_batch(cons, [(timestamp, session_id, snapshot, weight)
+                for session_id, snapshot, weight in rows])
+        finally:
+            cons.close()
+
+    def write(self, cons, sessions, snapshots):
+        """Like `Database.write`, but there's a transaction per partition."""
+        batches = OrderedDict()
+        for row in sessions:
+            key = self._locate(row[1], row[0])
+            batches.setdefault(key, ([], []))[0].append(row)
+        for row in snapshots:
+            key = self._locate(row[1], row[0])
+            batches.setdefault(key, ([], []))[1].append(row)
+        for key, (sessions, snapshots) in batches.items():
+            self.partition(key).write(cons.get(key), sessions, snapshots)
+
+    def write_snapshot_batch(self, cons, rows):
+        """Like `Database.write_snapshot_batch`, but there's a transaction per partition."""
+        batches = OrderedDict()
+        for i, row in enumerate(rows):
+            key = self._locate(row[1], row[0])
+            batches.setdefault(key, []).append((i, row))
+
+        accepted = [False for _ in rows]
+        for key, batch in batches.items():
+            results = self.partition(key).write_snapshot_batch(
+                    cons.get(key), [row for _, row in batch])
+            for (i, _), ok in zip(batch, results):
+                accepted[i] = ok
+        return accepted
+
+    def sessions(self, ids=None, start=None, end=None):
+        """Like `Database.sessions`, but only reads
+        the partitions overlapping `start` and `end`."""
+        sessions = []
+        for _, db in self.partitions(start, end):
+            sessions += db.sessions(ids, start=start, end=end)
+        return sessions
+
+    def session_stats(self, ids):
+        ids = list(ids)
+        stats = {}
+        for _, db in self.partitions():
+            stats.update(db.session_stats(ids))
+        return stats
+
+    def page_sessions(self, limit=100, after=None, start=None, end=None, **filters):
+        """Like `Database.page_sessions`, going through the partitions newest first."""
+        # Skip the partitions newer than the cursor
+        last = end
+        if after is not None:
+            timestamp, _ = parse_cursor(after)
+            last = datetime.utcfromtimestamp(timestamp)
+            last = last if end is None else min(end, last)
+
+        sessions = []
+        for key in reversed(self.keys(start, last)):
+            page, _ = self.partition(key).page_sessions(limit=limit - len(sessions),
+                    after=after, start=start, end=end, **filters)
+            sessions += page
+            if len(sessions) == limit:
+                return sessions, make_cursor(sessions[-1])
+        return sessions, None
+
+    def iter_snapshots(self, session_id, **kwargs):
+        db = self.find(session_id)
+        if db is not None:
+            yield from db.iter_snapshots(session_id, **kwargs)
+
+    def snapshots(self, session_id, **kwargs):
+        return list(self.iter_snapshots(session_id, **kwargs))
+
+    def snapshot_at(self, session_id, year, **kwargs):
+        db = self.find(session_id)
+        if db is None:
+            return None
+        return db.snapshot_at(session_id, year, **kwargs)
+
+    def _rollup(self, method, **kwargs):
+        """Sum the rollups (see `rollups.py`) over all partitions."""
+        total = Counter()
+        for _, db in self.partitions():
+            total.update(getattr(db, method)(**kwargs))
+        return total
+
+    def project_transitions(self, project=None, version=None):
+        return self._rollup('project_transitions', project=project, version=version)
+
+    def project_sessions(self, status='Active', version=None):
+        return self._rollup('project_sessions', status=status, version=version)
+
+    def process_mix(self, version=None):
+        return self._rollup('process_mix', version=version)
+
+    def years_reached(self, version=None):
+        return self._rollup('years_reached', version=version)
+
+    def rebuild_rollups(self, **kwargs):
+        return sum(db.rebuild_rollups(**kwargs) for _, db in self.partitions())
+
+    def query(self, *conditions, columns=('session', 'year'), limit=None):
+        """Like `Database.query`, over all partitions (oldest first)."""
+        rows = []
+        for _, db in self.partitions():
+            rows += db.query(*conditions, columns=columns,
+                    limit=None if limit is None else limit - len(rows))
+            if limit is not None and len(rows) >= limit:
+                break
+        return rows
+
+    def sessions_where(self, *conditions):
+        # Sessions are never split across partitions
+        return [id for _, db in self.partitions() for id in db.sessions_where(*conditions)]
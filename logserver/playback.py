@@ -0,0 +1,63 @@
+"""
+Bulk export of playback scripts (see `read.playback_script`)
+for many sessions into one zip archive, e.g.:
+
+    python playback.py --db logs.db --out playback.zip --version 1.2.0 --start 2022-05-01
+
+The archive has one `<session id>.json` script per session,
+plus an `index.json` listing the sessions (id, version, timestamp, years).
+Sessions are built in parallel on a process pool,
+each worker reading from its own database connection.
+"""
+
+import os
+import json
+import click
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from partitions import open_database
+from read import FIELDS, playback_script
+
+# Each worker's database
+_db = None
+
+def _init(path):
+    global _db
+    _db = open_database(path)
+
+def _script(session_id):
+    snapshots = _db.iter_snapshots(session_id, fields=FIELDS['playback'])
+    return session_id, json.dumps(playback_script(snapshots))
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--out', default='playback.zip', help='Path of the archive to write')
+@click.option('--version', 'versions', multiple=True, help='Only sessions of this game version (can be repeated)')
+@click.option('--start', default=None, help='Only sessions started on or after this date',
+        type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--end', default=None, help='Only sessions started before this date',
+        type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--workers', default=os.cpu_count(), help='Number of worker processes')
+def main(path, out, versions, start, end, workers):
+    db = open_database(path)
+    sessions = [s for s in db.sessions(start=start, end=end)
+            if s['n_snapshots'] > 0 and (not versions or s['version'] in versions)]
+    print('Exporting {} sessions...'.format(len(sessions)))
+
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as archive, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init, initargs=(path,)) as pool:
+        ids = (s['id'] for s in sessions)
+        for i, (session_id, script) in enumerate(pool.map(_script, ids, chunksize=8)):
+            archive.writestr('{}.json'.format(session_id), script)
+            print('  {}/{}'.format(i + 1, len(sessions)), end='\r')
+        archive.writestr('index.json', json.dumps([{
+            'id': s['id'],
+            'version': s['version'],
+            'timestamp': s['timestamp'],
+            'first_year': s['first_year'],
+            'last_year': s['last_year'],
+        } for s in sessions]))
+    print()
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,24 @@
 import sys
 import json
 import click
-from db import Database
+from partitions import open_database
+from db import gtco2eq
 from datetime import datetime
 
-def gtco2eq(byproducts):
-  co2eq = byproducts['co2_emissions'] + byproducts['ch4_emissions'] * 36 + byproducts['n2o_emissions'] * 298
-  return co2eq * 1e-15
+# The snapshot fields each analysis needs, so they can
+# be passed e.g. `db.iter_snapshots(id, fields=FIELDS['emissions'])`
+# to only decode those parts of the snapshots.
+FIELDS = {
+    'emissions': ['gameState.world'],
+    'process_mix': ['gameState.processes'],
+    'electricity_demand': ['gameState.world.year', 'gameState.output_demand'],
+    'active_projects': ['gameState.projects'],
+    'project_timeline': ['gameState.world.year', 'gameState.projects'],
+    'process_timeline': ['gameState.world.year', 'gameState.processes'],
+    'events': ['gameState.world.year', 'events'],
+}
+FIELDS['playback'] = sorted(set(
+    FIELDS['process_timeline'] + FIELDS['project_timeline'] + FIELDS['events']))
 
 def pprint(obj, indent=0, prefix=''):
     if isinstance(obj, list):
@@ -22,26 +34,38 @@ def pprint(obj, indent=0, prefix=''):
                     '  '*(indent-1 if i == 0 else indent),
                     k, v))
 
+# The per-snapshot analyses below include each snapshot's `weight`
+# (how many snapshots it stands in for, see `sampling.py`),
+# so that sampled sessions can be reweighted when aggregating them.
+
 def emissions(snapshots):
     return [{
         'year': s['snapshot']['gameState']['world']['year'],
-        'emissions': gtco2eq(s['snapshot']['gameState']['world'])
+        'emissions': gtco2eq(s['snapshot']['gameState']['world']),
+        'weight': s['weight'],
     } for s in snapshots]
 
+def last(snapshots):
+    s = None
+    for s in snapshots:
+        pass
+    return s
+
 def process_mix(snapshots):
     return [{
         'name': p['name'],
         'mix_share': p['mix_share']
-    } for p in snapshots[-1]['snapshot']['gameState']['processes']]
+    } for p in last(snapshots)['snapshot']['gameState']['processes']]
 
 def electricity_demand(snapshots):
     return [{
         'year': s['snapshot']['gameState']['world']['year'],
-        'demand': s['snapshot']['gameState']['output_demand']['electricity'] * 1e-9
+        'demand': s['snapshot']['gameState']['output_demand']['electricity'] * 1e-9,
+        'weight': s['weight'],
     } for s in snapshots]
 
 def active_projects(snapshots):
-    projects = snapshots[-1]['snapshot']['gameState']['projects']
+    projects = last(snapshots)['snapshot']['gameState']['projects']
     return [p for p in projects if p['status'] != 'Inactive']
 
 def project_timeline(snapshots):
@@ -81,41 +105,64 @@ def process_timeline(snapshots):
 def events(snapshots):
     return [{
         'year': s['snapshot']['gameState']['world']['year'],
-        'events': s['snapshot']['events']
+        'events': s['snapshot']['events'],
+        'weight': s['weight'],
     } for s in snapshots]
 
-def save_playback_script(snapshots, path):
+def playback_script(snapshots):
+    """The playback script for a session: what `process_timeline`,
+    `project_timeline` and `events` give (without the years),
+    built in a single pass over the snapshots."""
     script = {
         'processes': [],
         'projects': [],
         'events': [],
     }
-    for mix in process_timeline(snapshots):
-        del mix['year']
+    last_processes = {}
+    last_projects = {}
+    for s in snapshots:
+        state = s['snapshot']['gameState']
+
+        mix = {}
+        for p in state['processes']:
+            if last_processes.get(p['ref_id']) != p['mix_share']:
+                mix[p['ref_id']] = p['mix_share']
+            last_processes[p['ref_id']] = p['mix_share']
         script['processes'].append(mix)
-    for changes in project_timeline(snapshots):
-        del changes['year']
-        script['projects'].append({name: vals for name, vals in changes.items()})
-    for year in events(snapshots):
-        print(year['events'])
-        script['events'].append(year['events'])
+
+        changes = {}
+        for p in state['projects']:
+            if p['status'] != 'Inactive':
+                status = (p['status'], p['points'], p['level'])
+                if last_projects.get(p['ref_id']) != status:
+                    changes[p['ref_id']] = status
+                last_projects[p['ref_id']] = status
+        script['projects'].append(changes)
+
+        script['events'].append(s['snapshot']['events'])
+    return script
+
+def save_playback_script(snapshots, path):
     with open(path, 'w') as f:
-        json.dump(script, f)
+        json.dump(playback_script(snapshots), f)
 
 @click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
 @click.option('--id', default=None, help='Target session ID')
 @click.option('--script_path', default=None, help='Path to save playback script to')
 @click.option('--date', default=None, help='Target date',
         type=click.DateTime(formats=['%m/%d']))
-def main(id, script_path, date):
-    db = Database('logs.db')
-
-    sessions = db.sessions()
-    sessions.reverse()
-
-    # Browsing
-    if id is None and date is None:
-        sessions = sessions[:100]
+def main(path, id, script_path, date):
+    db = open_database(path)
+
+    if id is not None:
+        sessions = db.sessions(ids=[id])
+    elif date is None:
+        # Browsing: just the latest sessions
+        sessions, _ = db.page_sessions(limit=100)
+    else:
+        sessions = db.sessions()
+        sessions.reverse()
 
     for session in sessions:
         dt = datetime.utcfromtimestamp(float(session['timestamp']))
@@ -128,13 +175,16 @@ def main(id, script_path, date):
                 print(' ', dt, 'UTC')
                 print('  Version:', session['version'])
                 print('  User-Agent:', session['useragent'])
-                print('  Snapshots:', len(db.snapshots(session['id'])))
+                print('  Snapshots:', session['n_snapshots'])
+                print('  Duplicates:', session['n_duplicates'])
+                print('  Years:', session['first_year'], '-', session['last_year'])
 
         if session['id'] == id:
-            snapshots = db.snapshots(session['id'])
             if script_path:
+                snapshots = db.snapshots(session['id'], fields=FIELDS['playback'])
                 save_playback_script(snapshots, script_path)
             else:
+                snapshots = db.snapshots(session['id'])
                 import ipdb; ipdb.set_trace()
 
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+"""
+Rebuilds the rollups (see `rollups.py`) from the snapshots,
+e.g. to backfill them or after changing how they're computed.
+
+Each database is rebuilt in one transaction, which holds
+the write lock while it runs; for a big (unpartitioned) database
+it's best to run this while the server is stopped.
+"""
+
+import time
+import click
+from partitions import open_database
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--batch_size', default=100, help='Snapshots to read at a time')
+def main(path, batch_size):
+    start = time.time()
+    db = open_database(path)
+    n = db.rebuild_rollups(batch_size=batch_size)
+    print('Rebuilt rollups for {} sessions in {:.1f}s'.format(n, time.time() - start))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Batch replay of logged sessions through `engine/examples/playback.rs`,
+to check how far the engine's results have drifted from what players saw, e.g.:
+
+    cd ../engine && cargo build --release --example playback && cd -
+    python replay.py --db logs.db --out replay.csv --version 1.2.0 --start 2022-05-01
+
+For each session, its playback script (see `read.playback_script`) is
+run through the playback binary, and the world state the binary reports
+after each step (emissions, in Gt CO2eq, and temperature) is compared
+with the session's logged state the snapshot after. Sessions are replayed
+in parallel on a process pool, each worker reading from its own database
+connection and running one playback at a time.
+
+`--out` gets a CSV row per session with the mean, max and final absolute
+differences of each, and the first step where the temperature is off by more
+than `--threshold` (empty if never). Sessions whose playback fails (e.g. a
+project or event that's since been renamed) are listed with their `error`.
+"""
+
+import os
+import csv
+import json
+import click
+import tempfile
+import subprocess
+from statistics import median
+from concurrent.futures import ProcessPoolExecutor
+from partitions import open_database
+from read import FIELDS, playback_script
+from db import gtco2eq
+
+PLAYBACK = os.path.join(os.path.dirname(__file__), '..', 'engine', 'target', 'release', 'examples', 'playback')
+
+# What's compared: the logged value from a snapshot's
+# world and the playback binary's output line with it
+METRICS = {
+    'emissions': (gtco2eq, 'Emissions'),
+    'temperature': (lambda world: world['temperature'], 'Temp'),
+}
+
+WORLD_FIELDS = ['gameState.world.{}'.format(f) for f in
+        ['temperature', 'co2_emissions', 'ch4_emissions', 'n2o_emissions']]
+
+COLUMNS = ['session', 'version', 'steps', 'error', 'diverged_step'] + [
+        '{}_{}'.format(metric, stat)
+        for metric in METRICS for stat in ('mean', 'max', 'final')]
+
+# Each worker's database and settings
+_db = None
+_binary = None
+_timeout = None
+_threshold = None
+
+def _init(path, binary, timeout, threshold):
+    global _db, _binary, _timeout, _threshold
+    _db = open_database(path)
+    _binary = binary
+    _timeout = timeout
+    _threshold = threshold
+
+def parse_output(output):
+    """`{metric: [value after each step]}` from the playback binary's output."""
+    labels = {label: metric for metric, (_, label) in METRICS.items()}
+    steps = {metric: [] for metric in METRICS}
+    for line in output.splitlines():
+        label, _, value = line.strip().partition(': ')
+        if label in labels:
+            steps[labels[label]].append(float(value))
+    return steps
+
+def logged_values(snapshots):
+    """`{metric: [value at each snapshot]}` from the snapshots' worlds."""
+    values = {metric: [] for metric in METRICS}
+    for s in snapshots:
+        world = s['snapshot']['gameState']['world']
+        for metric, (fn, _) in METRICS.items():
+            try:
+                values[metric].append(fn(world))
+            except (KeyError, TypeError):
+                values[metric].append(None)
+    return values
+
+def divergence(replayed, logged, threshold):
+    """Divergence stats (the `COLUMNS` after `error`) of a replay from its session's
+    `logged_values`. Step `i` of the replay is compared with snapshot `i + 1`."""
+    row = {'steps': len(replayed['temperature']), 'diverged_step': None}
+    for metric in METRICS:
+        diffs = [(i, abs(r - l)) for i, (r, l) in enumerate(zip(replayed[metric], logged[metric][1:]))
+                if l is not None]
+        row['{}_mean'.format(metric)] = sum(d for _, d in diffs) / len(diffs) if diffs else None
+        row['{}_max'.format(metric)] = max(d for _, d in diffs) if diffs else None
+        row['{}_final'.format(metric)] = diffs[-1][1] if diffs else None
+        if metric == 'temperature':
+            row['diverged_step'] = next((i for i, d in diffs if d > threshold), None)
+    return row
+
+def replay(session_id):
+    """Replay one session with the worker's settings; its row of the summary."""
+    fields = sorted(set(FIELDS['playback'] + WORLD_FIELDS))
+    snapshots = _db.snapshots(session_id, fields=fields)
+    row = {'session': session_id, 'error': None}
+    fd, script_path = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(playback_script(snapshots), f)
+        proc = subprocess.run([_binary, script_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, timeout=_timeout)
+        if proc.returncode != 0:
+            lines = proc.stderr.strip().splitlines()
+            row['error'] = lines[-1] if lines else 'Exited with {}'.format(proc.returncode)
+            return row
+        row.update(divergence(parse_output(proc.stdout), logged_values(snapshots), _threshold))
+    except subprocess.TimeoutExpired:
+        row['error'] = 'Timed out after {}s'.format(_timeout)
+    finally:
+        os.remove(script_path)
+    return row
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--out', default='replay.csv', help='Path of the summary to write')
+@click.option('--id', 'ids', multiple=True, help='Session to replay (can be repeated; default all matching the filters)')
+@click.option('--version', 'versions', multiple=True, help='Only sessions of this game version (can be repeated)')
+@click.option('--start', default=None, help='Only sessions started on or after this date',
+        type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--end', default=None, help='Only sessions started before this date',
+        type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--binary', default=PLAYBACK, help='Path to the compiled playback example')
+@click.option('--threshold', default=0.1, help='Temperature difference (C) counted as diverged')
+@click.option('--timeout', default=300, help='Max seconds per session')
+@click.option('--workers', default=os.cpu_count(), help='Number of worker processes')
+def main(path, out, ids, versions, start, end, binary, threshold, timeout, workers):
+    if not os.path.exists(binary):
+        raise click.ClickException('No playback binary at {} (build it with '
+                '`cargo build --release --example playback` in `engine/`)'.format(binary))
+    db = open_database(path)
+    sessions = [s for s in db.sessions(ids=ids or None, start=start, end=end)
+            if s['n_snapshots'] > 1 and (not versions or s['version'] in versions)]
+    print('Replaying {} sessions...'.format(len(sessions)))
+
+    rows = []
+    with open(out, 'w', newline='') as f, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init,
+                    initargs=(path, os.path.abspath(binary), timeout, threshold)) as pool:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        session_ids = (s['id'] for s in sessions)
+        for session, row in zip(sessions, pool.map(replay, session_ids)):
+            row['version'] = session['version']
+            writer.writerow(row)
+            rows.append(row)
+            print('  {}/{}'.format(len(rows), len(sessions)), end='\r')
+    print()
+
+    failed = [r for r in rows if r['error']]
+    diverged = [r for r in rows if r.get('diverged_step') is not None]
+    print('{} replayed, {} failed, {} diverged by more than {}C'.format(
+        len(rows) - len(failed), len(failed), len(diverged), threshold))
+    for metric in METRICS:
+        maxes = [r['{}_max'.format(metric)] for r in rows if r.get('{}_max'.format(metric)) is not None]
+        if maxes:
+            print('  {}: median max difference {:.3f}, worst {:.3f}'.format(metric, median(maxes), max(maxes)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Downsamples old sessions to keep the database(s) small.
+
+For each session whose last snapshot is older than `--days`,
+keeps the last snapshot of every `--every`th year (counting from the
+session's first year) plus its final snapshot, then vacuums.
+The kept snapshots are re-encoded, so pass `--compress` (and `--normalize`)
+if the server runs with `COMPRESS_SNAPSHOTS` (and `NORMALIZE_SNAPSHOTS`)
+to store them the same way; otherwise they're stored plain.
+For a partitioned database (a directory, see `partitions.py`)
+only the partitions old enough to have such sessions are touched.
+"""
+
+import click
+from partitions import open_database, PartitionedDatabase
+from datetime import datetime, timedelta, timezone
+
+@click.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--days', default=30, help='Downsample sessions with no snapshots for this many days')
+@click.option('--every', default=5, help='Keep a snapshot every this many years')
+@click.option('--compress', is_flag=True, help='Compress the kept snapshots (see `COMPRESS_SNAPSHOTS`)')
+@click.option('--level', default=3, help='Compression level (see `COMPRESSION_LEVEL`)')
+@click.option('--normalize', is_flag=True, help='Normalize the kept snapshots (see `NORMALIZE_SNAPSHOTS`)')
+def main(path, days, every, compress, level, normalize):
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    before = cutoff.replace(tzinfo=timezone.utc).timestamp()
+
+    db = open_database(path, compress=compress, compression_level=level, normalize=normalize)
+    if isinstance(db, PartitionedDatabase):
+        # Sessions can't be newer than the partition they started in
+        dbs = db.partitions(end=cutoff)
+    else:
+        dbs = [(path, db)]
+
+    for name, d in dbs:
+        removed = d.downsample(before, every=every)
+        if removed:
+            print('{}: removed {} snapshots, vacuuming...'.format(name, removed))
+            d.vacuum()
+
+if __name__ == '__main__':
+    main()
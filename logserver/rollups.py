@@ -0,0 +1,163 @@
+"""
+Rollups of the telemetry, kept up to date as snapshots come in
+so that questions across all sessions are answered from small tables
+rather than by rescanning snapshots:
+
+- `project_transitions`: how many times each project went from one status to another
+- `project_sessions`: how many sessions each project reached each status in
+  (e.g. how many sessions activated Mass Electrification)
+- `process_mix`: histograms of each process' mix share, per year bucket
+  (each snapshot counted `weight` times, to make up for sampling; see `sampling.py`)
+- `years_reached`: histograms of the last year sessions reached
+
+All are per game version. Each session's running state
+(its projects' statuses and the last year it reached) is kept in `rollup_state`,
+so only the new snapshots need to be looked at.
+
+These can be rebuilt from the snapshots with `python rebuild.py`.
+"""
+
+import json
+from collections import Counter
+
+# Width (in years) of the `process_mix` buckets
+YEAR_BUCKET = 10
+
+# Projects start out with this status
+INITIAL_STATUS = 'Inactive'
+
+# What the rollups need out of each snapshot,
+# for `iter_snapshots(..., fields=FIELDS)`
+FIELDS = ['gameState.world.year', 'gameState.projects', 'gameState.processes']
+
+TABLES = ['rollup_state', 'project_transitions', 'project_sessions', 'process_mix', 'years_reached']
+
+def update(cur, rows):
+    """Roll up `(session_id, snapshot, weight)` rows (in the order they were
+    inserted), in the caller's transaction."""
+    by_session = {}
+    for session_id, snapshot, weight in rows:
+        by_session.setdefault(session_id, []).append((snapshot, weight))
+
+    transitions = Counter()
+    reached = Counter()
+    mix = Counter()
+    years = Counter()
+    states = []
+    for session_id, snapshots in by_session.items():
+        row = cur.execute(
+                'SELECT version, last_year, projects FROM rollup_state WHERE session == ?',
+                (session_id,)).fetchone()
+        if row is None:
+            version, = cur.execute(
+                    'SELECT version FROM sessions WHERE session == ?',
+                    (session_id,)).fetchone() or (None,)
+            last_year, projects = None, {}
+        else:
+            version, last_year, projects = row
+            projects = json.loads(projects)
+        version = version or ''
+        prev_year = last_year
+
+        for snapshot, weight in snapshots:
+            # Snapshots are whatever clients sent, so skip anything malformed
+            # rather than failing the writer's transaction
+            state = _dict(_dict(snapshot).get('gameState'))
+            for p in _list(state.get('projects')):
+                name, status = _dict(p).get('name'), _dict(p).get('status')
+                if not isinstance(name, str) or not isinstance(status, str):
+                    continue
+                # [current status, statuses reached]
+                current, seen = projects.get(name, [INITIAL_STATUS, [INITIAL_STATUS]])
+                if status != current:
+                    transitions[version, name, current, status] += 1
+                if status not in seen:
+                    seen = seen + [status]
+                    reached[version, name, status] += 1
+                projects[name] = [status, seen]
+
+            # Count each session's processes once per year
+            year = _dict(state.get('world')).get('year')
+            if not isinstance(year, int) or (last_year is not None and year <= last_year):
+                continue
+            last_year = year
+            bucket = year - year % YEAR_BUCKET
+            for p in _list(state.get('processes')):
+                name, mix_share = _dict(p).get('name'), _dict(p).get('mix_share')
+                if isinstance(name, str) and isinstance(mix_share, (int, float)):
+                    mix[version, bucket, name, mix_share] += weight
+
+        if last_year != prev_year:
+            if prev_year is not None:
+                years[version, prev_year] -= 1
+            years[version, last_year] += 1
+        states.append((session_id, version, last_year, json.dumps(projects)))
+
+    cur.executemany(
+        'INSERT OR REPLACE INTO rollup_state(session, version, last_year, projects) VALUES (?,?,?,?)',
+        states)
+    _increment(cur, 'project_transitions', ['version', 'project', 'from_status', 'to_status'], transitions)
+    _increment(cur, 'project_sessions', ['version', 'project', 'status'], reached)
+    _increment(cur, 'process_mix', ['version', 'bucket', 'process', 'mix_share'], mix)
+    _increment(cur, 'years_reached', ['version', 'year'], years)
+
+def _dict(obj):
+    return obj if isinstance(obj, dict) else {}
+
+def _list(obj):
+    return obj if isinstance(obj, list) else []
+
+def _increment(cur, table, keys, counts):
+    cur.executemany(
+        'INSERT INTO {table}({keys}, n) VALUES ({params}, ?) \
+            ON CONFLICT({keys}) DO UPDATE SET n = n + excluded.n'.format(
+            table=table, keys=', '.join(keys), params=','.join('?' for _ in keys)),
+        [(*key, n) for key, n in counts.items() if n != 0])
+
+def _query(cur, table, keys, version=None, **filters):
+    """`Counter` of `n` (summed over versions unless `version` is given),
+    keyed by `keys`, optionally filtered by `filters` (column=value)."""
+    where = ['n != 0']
+    params = []
+    if version is not None:
+        where.append('version == ?')
+        params.append(version)
+    for col, val in filters.items():
+        if val is not None:
+            where.append('{} == ?'.format(col))
+            params.append(val)
+    rows = cur.execute('SELECT {keys}, SUM(n) FROM {table} WHERE {where} GROUP BY {keys}'.format(
+        keys=', '.join(keys), table=table, where=' AND '.join(where)), params)
+    return Counter({row[0] if len(keys) == 1 else tuple(row[:-1]): row[-1] for row in rows})
+
+def project_transitions(cur, project=None, version=None):
+    """`{(project, from_status, to_status): count}`"""
+    return _query(cur, 'project_transitions', ['project', 'from_status', 'to_status'],
+            version=version, project=project)
+
+def project_sessions(cur, status='Active', version=None):
+    """`{project: number of sessions that reached status}`"""
+    return _query(cur, 'project_sessions', ['project'], version=version, status=status)
+
+def process_mix(cur, version=None):
+    """`{(year bucket, process, mix share): count}`"""
+    return _query(cur, 'process_mix', ['bucket', 'process', 'mix_share'], version=version)
+
+def years_reached(cur, version=None):
+    """`{last year reached: number of sessions}`"""
+    return _query(cur, 'years_reached', ['year'], version=version)
+
+def mean_mix(histogram):
+    """Mean mix share per year bucket and process,
+    `{bucket: {process: mean}}`, from a `process_mix` histogram."""
+    totals = {}
+    for (bucket, process, share), n in histogram.items():
+        t = totals.setdefault(bucket, {}).setdefault(process, [0, 0])
+        t[0] += share * n
+        t[1] += n
+    return {bucket: {process: s / n for process, (s, n) in procs.items()}
+            for bucket, procs in sorted(totals.items())}
+
+def clear(cur):
+    for table in TABLES:
+        cur.execute('DELETE FROM {}'.format(table))
@@ -0,0 +1,135 @@
+"""
+Server-side sampling of incoming snapshots, so that the write path
+stays bounded during traffic spikes (e.g. a launch) rather than
+the write queue filling up and every client getting `503`s.
+
+Set `SAMPLING_CAPACITY` in `config.py` to the number of snapshots
+per second the server should write at most (e.g. what `loadtest.py`
+shows it keeps up with). While snapshots come in faster than that,
+mid-game snapshots are thinned by year: only those in years that are
+a multiple of the sampling interval (the smallest of `SAMPLING_INTERVALS`
+that brings the rate under capacity) are kept. Whatever the load:
+
+- a session's first snapshot and its last one (the game is over
+  or has reached `SAMPLING_END_YEAR`) are always kept
+- a deterministic subset of sessions (a `SAMPLING_PANEL` fraction of them,
+  picked by a hash of the session id; see `in_panel`) is never thinned,
+  so there's always a full-resolution sample to compare against
+
+Each kept snapshot's `weight` is how many of its session's snapshots
+it stands in for (itself plus the ones dropped since the session's
+previous kept snapshot). It's stored with the snapshot (`snapshots.weight`)
+and returned by `Database.iter_snapshots`, so analyses can reweight
+(e.g. the `process_mix` rollup counts each snapshot `weight` times).
+Dropped snapshots after a session's last kept one (if it's abandoned
+mid-game) aren't counted anywhere.
+
+The state is in memory and per server process.
+"""
+
+import zlib
+import threading
+from time import monotonic
+from collections import OrderedDict
+import metrics
+from db import snapshot_year
+
+# How many sessions to remember the dropped snapshot counts of
+SESSION_CACHE_SIZE = 100000
+
+def in_panel(session_id, panel):
+    """Whether a session is in the never-thinned subset.
+    Uses crc32 rather than `hash` so it's the same in every process."""
+    return zlib.crc32(session_id.encode('utf8')) < panel * 2**32
+
+def is_final(snapshot, end_year):
+    """Whether it's a session's last snapshot (game over or the end year).
+    False for malformed snapshots, which are stored as they are."""
+    if not isinstance(snapshot, dict):
+        return False
+    state = snapshot.get('gameState')
+    year = snapshot_year(snapshot)
+    return bool(isinstance(state, dict) and state.get('game_over')) \
+            or (isinstance(year, int) and year >= end_year)
+
+class Sampler:
+    """Decides which snapshots to keep; see the module docstring.
+    `capacity` is in snapshots per second, `None` to keep everything."""
+
+    def __init__(self, capacity=None, intervals=(2, 5, 10), panel=0.02, end_year=2100):
+        self.capacity = capacity
+        self.intervals = [1] + sorted(intervals)
+        self.panel = panel
+        self.end_year = end_year
+        self._lock = threading.Lock()
+
+        # session_id -> snapshots dropped since its last kept one
+        self._dropped = OrderedDict()
+
+        # Snapshots offered in the current and previous second
+        self._second = None
+        self._count = 0
+        self._last_count = 0
+
+        self.interval = 1
+        metrics.SAMPLING_INTERVAL.set_function(lambda: self.interval)
+
+    def _rate(self):
+        """Snapshots per second being offered, as of this one"""
+        second = int(monotonic())
+        if second != self._second:
+            self._last_count = self._count if self._second == second - 1 else 0
+            self._second = second
+            self._count = 0
+        self._count += 1
+        return max(self._count, self._last_count)
+
+    def _interval(self, rate):
+        """The smallest interval that would bring the rate of kept snapshots
+        under capacity (the panel is kept in full), or the largest one"""
+        for interval in self.intervals:
+            if rate * (self.panel + (1 - self.panel) / interval) <= self.capacity:
+                return interval
+        return self.intervals[-1]
+
+    def sample(self, session_id, snapshot):
+        """The weight to store `snapshot` with, or `None` to drop it."""
+        if self.capacity is None:
+            return 1
+        with self._lock:
+            self.interval = self._interval(self._rate())
+            first = session_id not in self._dropped
+            dropped = self._dropped.pop(session_id, 0)
+            year = snapshot_year(snapshot)
+            keep = first \
+                    or self.interval == 1 \
+                    or not isinstance(year, int) \
+                    or year % self.interval == 0 \
+                    or is_final(snapshot, self.end_year) \
+                    or in_panel(session_id, self.panel)
+
+            self._dropped[session_id] = 0 if keep else dropped + 1
+            while len(self._dropped) > SESSION_CACHE_SIZE:
+                self._dropped.popitem(last=False)
+
+        metrics.SAMPLED.inc('kept' if keep else 'dropped')
+        return dropped + 1 if keep else None
+
+    def sample_batch(self, rows):
+        """Sample `(session_id, snapshot)` rows. Returns the
+        `(session_id, snapshot, weight)` rows to keep and whether each row was kept."""
+        kept = []
+        keep = []
+        for session_id, snapshot in rows:
+            weight = self.sample(session_id, snapshot)
+            if weight is not None:
+                kept.append((session_id, snapshot, weight))
+            keep.append(weight is not None)
+        return kept, keep
+
+def results(keep, accepted):
+    """Per-row acceptance for sampled rows, given the insert results
+    for the kept ones. Dropped rows count as accepted, since
+    the client shouldn't retry them."""
+    accepted = iter(accepted)
+    return [next(accepted) if k else True for k in keep]
@@ -0,0 +1,96 @@
+"""
+What `main.py` and `asgi.py` share: the database, sampler,
+live view and limits, set up from `config.py` (see the readme's Config section)
+in one place so the two servers behave the same.
+"""
+
+import config
+import sampling
+from time import monotonic
+from db import Database
+from partitions import PartitionedDatabase
+from shards import ShardedDatabase
+from live import Live
+
+# Set `PARTITION = 'day'` (or `'week'`) in `config.py`
+# to spread sessions across a database file per day (or week)
+if getattr(config, 'PARTITION', None):
+    db = PartitionedDatabase(getattr(config, 'PARTITION_DIR', 'logs'),
+            period=config.PARTITION,
+            keyframe_interval=getattr(config, 'KEYFRAME_INTERVAL', 20),
+            compress=getattr(config, 'COMPRESS_SNAPSHOTS', False),
+            compression_level=getattr(config, 'COMPRESSION_LEVEL', 3),
+            normalize=getattr(config, 'NORMALIZE_SNAPSHOTS', False))
+else:
+    db = Database('logs.db',
+            keyframe_interval=getattr(config, 'KEYFRAME_INTERVAL', 20),
+            compress=getattr(config, 'COMPRESS_SNAPSHOTS', False),
+            compression_level=getattr(config, 'COMPRESSION_LEVEL', 3),
+            normalize=getattr(config, 'NORMALIZE_SNAPSHOTS', False))
+
+# Set `SHARDS = True` in `config.py` when running several worker processes
+# to have each write to its own shards, which are merged into `db` in the background.
+# The servers close it on shutdown, after their writer.
+if getattr(config, 'SHARDS', False):
+    db = ShardedDatabase(db, getattr(config, 'SHARD_DIR', 'shards'),
+            interval=getattr(config, 'SHARD_INTERVAL', 5),
+            keyframe_interval=getattr(config, 'KEYFRAME_INTERVAL', 20))
+    db.start()
+
+# Write-behind settings, for `writer.Writer` and `asgi.AsyncWriter`
+# (see `batches` below)
+WRITER = {
+    'max_queue': getattr(config, 'WRITE_MAX_QUEUE', 10000),
+    'batch_size': getattr(config, 'WRITE_BATCH_SIZE', 500),
+    'flush_interval': getattr(config, 'WRITE_FLUSH_INTERVAL', 1.),
+}
+
+def batches(batch_size, flush_interval, stop, clock=monotonic):
+    """The batching loop of `writer.Writer` and `asgi.AsyncWriter`, which
+    each wait on their own kind of queue. Yields how long to wait for the next
+    queued item (`None` for as long as it takes) and is sent the item (`None` if
+    the wait timed out), or yields a list of items to write in one batch (and is
+    sent `None`). A batch is ready once it has `batch_size` items or
+    `flush_interval` seconds after its first. Finishes once it's sent `stop`."""
+    stopping = False
+    while not stopping:
+        item = yield None
+        if item is stop:
+            return
+
+        batch = [item]
+        deadline = clock() + flush_interval
+        # Flush right away if someone's waiting on an uploaded batch
+        while len(batch) < batch_size and batch[-1][0] != 'batch':
+            timeout = deadline - clock()
+            if timeout <= 0:
+                break
+            item = yield timeout
+            if item is None:
+                break
+            if item is stop:
+                stopping = True
+                break
+            batch.append(item)
+        yield batch
+
+# Thin out incoming snapshots when they come in faster than
+# `SAMPLING_CAPACITY` per second (see `sampling.py`)
+sampler = sampling.Sampler(
+        capacity=getattr(config, 'SAMPLING_CAPACITY', None),
+        intervals=getattr(config, 'SAMPLING_INTERVALS', (2, 5, 10)),
+        panel=getattr(config, 'SAMPLING_PANEL', 0.02),
+        end_year=getattr(config, 'SAMPLING_END_YEAR', 2100))
+
+# Rolling aggregates for `GET /live` (see `live.py`)
+live = Live(window=getattr(config, 'LIVE_WINDOW', 300))
+LIVE_INTERVAL = getattr(config, 'LIVE_INTERVAL', 1.)
+# Each stream holds a worker while it's open (`main.py` only)
+LIVE_MAX_STREAMS = getattr(config, 'LIVE_MAX_STREAMS', 1)
+
+# Limits for `/snapshots` batch uploads
+MAX_BATCH_BYTES = getattr(config, 'MAX_BATCH_BYTES', 64 * 1024 * 1024)
+MAX_BATCH_RECORDS = getattr(config, 'MAX_BATCH_RECORDS', 1000)
+
+# Max sessions/snapshots per page from the read-only API (see `api.py`)
+MAX_PAGE_SIZE = getattr(config, 'MAX_PAGE_SIZE', 1000)
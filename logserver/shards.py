@@ -0,0 +1,463 @@
+"""
+Per-worker write shards, for running a server with several worker processes
+(e.g. `gunicorn -w 4 main:app` or `uvicorn --workers 4 asgi:app`)
+without them all waiting on the main database's write lock.
+
+With `SHARDS = True` in `config.py`, each worker writes to its own small
+shard file in `SHARD_DIR`, starting a new one every `SHARD_INTERVAL` seconds
+(`<period>-<pid>.db`, holding the rows that came in during that period),
+so writes scale with the number of workers.
+A background thread in each worker periodically seals its shards of the periods
+that are over (closing its connections to them and adding a `<key>.sealed` file),
+merges the periods whose shards are all sealed into the main database (`logs.db`
+or the `PARTITION` files), one worker at a time (they take turns through
+a lock file), and deletes them. Shards of workers that died are merged as they are.
+
+- each period's shards are merged in timestamp order, so a session's
+  snapshots reach the main database in the order they came in even if its
+  requests were spread over several workers. They're streamed in batches of
+  `MERGE_BATCH_SIZE`, one transaction each, so a period is never all in memory
+- sessions are deduplicated by the main database as usual: a session's row
+  is only inserted once and snapshots already in its session are skipped,
+  so merging a shard again after being interrupted is harmless
+- a shard that can't be read, or that has rows the main database rejects,
+  is set aside as `<key>.failed` (counted in `logserver_failed_shards_total`)
+  for a look later, rather than holding up the periods after it. Its rows
+  that could be merged are, and its rejected rows are logged
+
+Reads (`sessions`, `page_sessions`, `iter_snapshots`, ...) combine the main
+database with the shards that haven't been merged yet, so new data shows up
+right away. A session's unmerged snapshots come after its merged ones
+and have no `id` (so there's no cursor past them) until they're merged.
+The rollups need each session's snapshots in order, so they're only
+read from the main database, i.e. they're up to date as of the last merge.
+
+A worker merges its own shards when it shuts down. Counts of copies skipped
+within a shard (`n_duplicates`) aren't carried over when it's merged.
+"""
+
+import os
+import re
+import fcntl
+import heapq
+import logging
+import threading
+import weakref
+import metrics
+from db import Database, now, make_cursor
+from partitions import Connections
+
+logger = logging.getLogger(__name__)
+
+# Snapshots to read from a shard at a time when merging
+MERGE_BATCH_SIZE = 500
+
+EMPTY_STATS = {'n_snapshots': 0, 'first_year': None, 'last_year': None,
+        'last_timestamp': None, 'n_duplicates': 0}
+
+def shard_key(period, pid):
+    return '{}-{}'.format(period, pid)
+
+def parse_key(key):
+    """`(period, pid)` of a shard key. Raises `ValueError` if it isn't one."""
+    match = re.fullmatch(r'(\d+)-(\d+)', key)
+    if match is None:
+        raise ValueError('Not a shard: {}'.format(key))
+    return int(match.group(1)), int(match.group(2))
+
+def add_stats(a, b):
+    """Two parts of a session's stats (see `db.STATS_FIELDS`), combined"""
+    def pick(fn, x, y):
+        return x if y is None else y if x is None else fn(x, y)
+    return {
+        'n_snapshots': a['n_snapshots'] + b['n_snapshots'],
+        'first_year': pick(min, a['first_year'], b['first_year']),
+        'last_year': pick(max, a['last_year'], b['last_year']),
+        'last_timestamp': pick(max, a['last_timestamp'], b['last_timestamp']),
+        'n_duplicates': a['n_duplicates'] + b['n_duplicates'],
+    }
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _timestamp(item):
+    """Timestamp of a `(row, shard key)` item"""
+    return float(item[0][0])
+
+def _rows(db, key, failed):
+    """A shard's snapshots as `((timestamp, session_id, snapshot, weight), key)`, in id order.
+    Stops, adding `key` to `failed`, if the shard can't be read."""
+    after = 0
+    while True:
+        try:
+            snapshots = db.snapshots_since(after, limit=MERGE_BATCH_SIZE)
+        except Exception:
+            logger.exception('Failed to read shard {}'.format(key))
+            failed.add(key)
+            return
+        for s in snapshots:
+            yield (s['timestamp'], s['session_id'], s['snapshot'], s['weight']), key
+        if len(snapshots) < MERGE_BATCH_SIZE:
+            return
+        after = snapshots[-1]['id']
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class ShardedDatabase:
+    """Writes to this worker's shards and reads from them and `main`
+    (a `Database` or `PartitionedDatabase`); see the module docstring.
+    Has the parts of the `Database` interface the servers use."""
+
+    def __init__(self, main, path='shards', interval=5, keyframe_interval=20):
+        self.main = main
+        self.path = path
+        self.interval = interval
+        self.keyframe_interval = keyframe_interval
+        self._shards = {}
+        self._lock = threading.Lock()
+
+        # Held while writing to or sealing this worker's shards
+        self._write_lock = threading.Lock()
+        # This worker's open `Connections`, to close when sealing
+        self._cons = weakref.WeakSet()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(path, exist_ok=True)
+
+    def period(self):
+        return int(now() // self.interval)
+
+    def keys(self):
+        """Keys of the existing shards (of all workers), oldest first."""
+        keys = []
+        for fname in os.listdir(self.path):
+            key, ext = os.path.splitext(fname)
+            if ext != '.db':
+                continue
+            try:
+                keys.append((parse_key(key), key))
+            except ValueError:
+                continue
+        return [key for _, key in sorted(keys)]
+
+    def partition(self, key):
+        """The shard with `key` (named so that `partitions.Connections` can open it)."""
+        with self._lock:
+            db = self._shards.get(key)
+            if db is None:
+                db = self._shards[key] = Database(self._file(key),
+                        keyframe_interval=self.keyframe_interval)
+            return db
+
+    def shards(self):
+        """The shards that haven't been merged yet, oldest first."""
+        keys = self.keys()
+        with self._lock:
+            for key in set(self._shards) - set(keys):
+                del self._shards[key]
+        return [self.partition(key) for key in keys]
+
+    def _sources(self):
+        return [self.main] + self.shards()
+
+    def _file(self, key, ext='.db'):
+        return os.path.join(self.path, key + ext)
+
+    def writer_con(self):
+        # Writes only go to the current and previous periods' shards
+        cons = Connections(self, max_open=2)
+        self._cons.add(cons)
+        return cons
+
+    def add_session(self, session_id, version, user_agent):
+        cons = self.writer_con()
+        try:
+            self.write(cons, [(now(), session_id, version, user_agent)], [])
+        finally:
+            cons.close()
+
+    def add_snapshot(self, session_id, snapshot, weight=1):
+        cons = self.writer_con()
+        try:
+            self.write(cons, [], [(now(), session_id, snapshot, weight)])
+        finally:
+            cons.close()
+
+    def add_snapshots(self, rows):
+        cons = self.writer_con()
+        timestamp = now()
+        try:
+            return self.write_snapshot_batch(cons, [(timestamp, session_id, snapshot, weight)
+                for session_id, snapshot, weight in rows])
+        finally:
+            cons.close()
+
+    def _key(self, timestamp):
+        """The key of this worker's shard for rows from `timestamp`.
+        Rows go in the shard of the period they came in, so that merging
+        the periods in order keeps them in order, unless that period's shards
+        may be being merged already (the write was held up for a whole period)."""
+        period = max(int(float(timestamp) // self.interval), self.period() - 1)
+        # The pid is looked up every time in case we were forked
+        return shard_key(period, os.getpid())
+
+    def write(self, cons, sessions, snapshots):
+        """Like `Database.write`, into this worker's shards."""
+        # Keys are picked under the lock, so a period can't be
+        # sealed (and merged) between picking its shard and writing to it
+        with self._write_lock:
+            batches = {}
+            for row in sessions:
+                batches.setdefault(self._key(row[0]), ([], []))[0].append(row)
+            for row in snapshots:
+                batches.setdefault(self._key(row[0]), ([], []))[1].append(row)
+            for key, (sessions, snapshots) in sorted(batches.items()):
+                self.partition(key).write(cons.get(key), sessions, snapshots)
+
+    def write_snapshot_batch(self, cons, rows):
+        """Like `Database.write_snapshot_batch`, into this worker's shard
+        (the rows of an uploaded batch all have the same timestamp)."""
+        if not rows:
+            return []
+        with self._write_lock:
+            key = self._key(rows[0][0])
+            return self.partition(key).write_snapshot_batch(cons.get(key), rows)
+
+    def has_session(self, session_id):
+        return any(db.has_session(session_id) for db in self._sources())
+
+    def _combine(self, sessions, dbs):
+        """`{session_id: session}` for `sessions` (from any of `dbs`), each with
+        the earliest of its rows (the one that's kept once merged)
+        and its stats summed over `dbs`."""
+        combined = {}
+        for s in sorted(sessions, key=lambda s: float(s['timestamp'])):
+            combined.setdefault(s['id'], s)
+        stats = {}
+        for db in dbs:
+            for session_id, s in db.session_stats(combined).items():
+                stats[session_id] = add_stats(stats[session_id], s) if session_id in stats else s
+        for session_id, s in combined.items():
+            s.update(stats.get(session_id, EMPTY_STATS))
+        return combined
+
+    def sessions(self, ids=None, start=None, end=None):
+        ids = None if ids is None else list(ids)
+        dbs = self._sources()
+        sessions = [s for db in dbs for s in db.sessions(ids, start=start, end=end)]
+        return list(self._combine(sessions, dbs).values())
+
+    def page_sessions(self, limit=100, after=None, **filters):
+        """Like `Database.page_sessions`, over the main database and the shards."""
+        dbs = self._sources()
+        sessions = []
+        for db in dbs:
+            page, _ = db.page_sessions(limit=limit, after=after, **filters)
+            sessions += page
+        sessions = sorted(self._combine(sessions, dbs).values(),
+                key=lambda s: (float(s['timestamp']), s['id']), reverse=True)[:limit]
+        cursor = make_cursor(sessions[-1]) if len(sessions) == limit else None
+        return sessions, cursor
+
+    def session_stats(self, ids):
+        ids = list(ids)
+        stats = {}
+        for db in self._sources():
+            for session_id, s in db.session_stats(ids).items():
+                stats[session_id] = add_stats(stats[session_id], s) if session_id in stats else s
+        return stats
+
+    def iter_snapshots(self, session_id, after=0, **kwargs):
+        """Like `Database.iter_snapshots`; `after` only applies to merged snapshots
+        (unmerged ones come last, without ids)."""
+        yield from self.main.iter_snapshots(session_id, after=after, **kwargs)
+        shards = [db.iter_snapshots(session_id, **kwargs) for db in self.shards()]
+        for s in heapq.merge(*shards, key=lambda s: float(s['timestamp'])):
+            yield dict(s, id=None)
+
+    def snapshots(self, session_id, **kwargs):
+        return list(self.iter_snapshots(session_id, **kwargs))
+
+    def snapshot_at(self, session_id, year, **kwargs):
+        snapshot = self.main.snapshot_at(session_id, year, **kwargs)
+        # Unmerged snapshots are newer
+        for db in self.shards():
+            s = db.snapshot_at(session_id, year, **kwargs)
+            if s is not None:
+                snapshot = dict(s, id=None)
+        return snapshot
+
+    def query(self, *conditions, columns=('session', 'year'), limit=None):
+        """Like `Database.query`, over the main database and then the shards."""
+        rows = []
+        for db in self._sources():
+            rows += db.query(*conditions, columns=columns,
+                    limit=None if limit is None else limit - len(rows))
+            if limit is not None and len(rows) >= limit:
+                break
+        return rows
+
+    def sessions_where(self, *conditions):
+        ids = {}
+        for db in self._sources():
+            ids.update(dict.fromkeys(db.sessions_where(*conditions)))
+        return list(ids)
+
+    def project_transitions(self, project=None, version=None):
+        return self.main.project_transitions(project=project, version=version)
+
+    def project_sessions(self, status='Active', version=None):
+        return self.main.project_sessions(status=status, version=version)
+
+    def process_mix(self, version=None):
+        return self.main.process_mix(version=version)
+
+    def years_reached(self, version=None):
+        return self.main.years_reached(version=version)
+
+    def seal(self, final=False):
+        """Seal this worker's shards of the periods it won't write to anymore
+        (before the previous one; see `_key`), or with `final` all of them."""
+        pid = os.getpid()
+        with self._write_lock:
+            current = self.period()
+            for key in self.keys():
+                period, key_pid = parse_key(key)
+                if key_pid != pid or (period >= current - 1 and not final) \
+                        or os.path.exists(self._file(key, '.sealed')):
+                    continue
+                for cons in list(self._cons):
+                    con = cons.cons.pop(key, None)
+                    if con is not None:
+                        con.close()
+                open(self._file(key, '.sealed'), 'w').close()
+
+    def _sealed(self, key):
+        _, pid = parse_key(key)
+        return os.path.exists(self._file(key, '.sealed')) or not is_alive(pid)
+
+    def merge(self, final=False):
+        """Seal this worker's shards that are done (see `seal`),
+        and merge the periods whose shards are all sealed into the main database,
+        oldest first, and delete them. With `final` (once this worker's done writing),
+        seal all of this worker's shards and wait for any other merge.
+        Returns the number of snapshots merged, or `None` if another worker is merging."""
+        self.seal(final)
+        with open(self._file('merge', '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if final else fcntl.LOCK_NB))
+            except BlockingIOError:
+                return None
+
+            periods = {}
+            for key in self.keys():
+                periods.setdefault(parse_key(key)[0], []).append(key)
+            n = 0
+            for _, keys in sorted(periods.items()):
+                # Later periods have to wait, to keep the snapshots in order
+                if not all(self._sealed(key) for key in keys):
+                    break
+                n += self._merge(keys)
+            return n
+
+    def _merge(self, keys):
+        # Keys of the shards that couldn't be (completely) merged
+        failed = set()
+        n = 0
+        with metrics.MERGE_SECONDS.time():
+            sessions = []
+            for key in keys:
+                try:
+                    sessions += [((s['timestamp'], s['id'], s['version'], s['useragent']), key)
+                            for s in self.partition(key).sessions()]
+                except Exception:
+                    logger.exception('Failed to read shard {}'.format(key))
+                    failed.add(key)
+            cons = self.main.writer_con()
+            try:
+                self._write(cons, sorted(sessions, key=_timestamp), [], failed)
+                snapshots = heapq.merge(*[_rows(self.partition(key), key, failed) for key in keys
+                    if key not in failed], key=_timestamp)
+                for batch in _batches(snapshots, MERGE_BATCH_SIZE):
+                    n += self._write(cons, [], batch, failed)
+            finally:
+                cons.close()
+
+        for key in keys:
+            with self._lock:
+                self._shards.pop(key, None)
+            if key in failed:
+                # Set it aside, where `keys` won't find it
+                metrics.FAILED_SHARDS.inc()
+                for ext in ['.db', '.db-wal', '.db-shm']:
+                    try:
+                        os.replace(self._file(key, ext), self._file(key, ext.replace('.db', '.failed')))
+                    except FileNotFoundError:
+                        pass
+                logger.error('Set aside shard {} as {}'.format(key, self._file(key, '.failed')))
+            for ext in ['.db', '.db-wal', '.db-shm', '.sealed']:
+                try:
+                    os.remove(self._file(key, ext))
+                except FileNotFoundError:
+                    pass
+        metrics.MERGED.inc(n=n)
+        return n
+
+    def _write(self, cons, sessions, snapshots, failed):
+        """Write `(row, shard key)` items of session and snapshot rows to the main
+        database in one transaction or, if that fails, one at a time, adding the keys
+        of the shards of rows that still fail to `failed`. Returns the number written."""
+        try:
+            self.main.write(cons, [row for row, _ in sessions], [row for row, _ in snapshots])
+            return len(snapshots)
+        except Exception:
+            pass
+        for row, key in sessions:
+            try:
+                self.main.write(cons, [row], [])
+            except Exception:
+                logger.exception('Failed to merge session {} from shard {}'.format(row[1], key))
+                failed.add(key)
+        n = 0
+        for row, key in snapshots:
+            try:
+                self.main.write(cons, [], [row])
+                n += 1
+            except Exception:
+                logger.exception('Failed to merge snapshot of {} from shard {}'.format(row[1], key))
+                failed.add(key)
+        return n
+
+    def start(self):
+        """Merge every `interval` seconds, on a background thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.merge()
+            except Exception:
+                logger.exception('Failed to merge shards')
+
+    def close(self):
+        """Stop merging in the background and merge this worker's shards.
+        Call once its writer is closed."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.merge(final=True)
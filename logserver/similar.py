@@ -0,0 +1,266 @@
+"""
+Finding sessions that were played like a given one
+(e.g. "same process mix trajectory and projects as this bug report").
+
+Each session gets a feature vector (see `features`) from its
+`read.process_timeline` and `read.project_timeline`:
+
+- each process' mix share at the end of each decade
+- when each project was completed (earlier is higher, 0 if never)
+
+The vectors are projected (PCA) down to `DIMS` dimensions,
+so the index stays small (128 bytes per session) and a query is one
+pass over a `(session, DIMS)` array, a few milliseconds even for
+hundreds of thousands of sessions:
+
+    index = Index.load(db)
+    index.similar(session_id, k=10)   # [(session_id, distance), ...]
+
+or `python similar.py query --id <session>`. The index is cached on disk
+(by default in `similar.npz`) and, like `analytics.py`, later loads only
+read sessions that are new or have new snapshots. The processes, projects
+and projection are fixed when the index is first built; pass `refit=True`
+(`--refit`) to rebuild them from all the sessions. Requires `numpy`.
+"""
+
+import os
+import json
+import time
+import click
+import numpy as np
+from read import FIELDS as READ_FIELDS, process_timeline, project_timeline
+from partitions import open_database
+
+# What `features` needs out of each snapshot
+FIELDS = sorted(set(READ_FIELDS['process_timeline'] + READ_FIELDS['project_timeline']))
+
+DECADES = list(range(2020, 2100, 10))
+START_YEAR, END_YEAR = 2020, 2100
+
+# Statuses a project has once it's been completed
+COMPLETED = ['Active', 'Finished']
+
+# Mix shares are in 5% units
+MAX_MIX_SHARE = 20
+
+# Dimensions the feature vectors are projected down to
+DIMS = 32
+
+# Max sessions to fit the projection on
+FIT_SAMPLE = 20000
+
+def timelines(db, session_id):
+    """`(process_timeline, project_timeline)` of a session,
+    decoding its snapshots once."""
+    snapshots = db.snapshots(session_id, fields=FIELDS)
+    return process_timeline(snapshots), project_timeline(snapshots)
+
+def _years(timeline):
+    for entry in timeline:
+        year = entry['year']
+        if isinstance(year, int):
+            yield year, entry
+
+def mix_by_decade(processes):
+    """`{process: [mix share at the end of each of the DECADES]}`
+    from a `process_timeline`. Decades a session didn't reach
+    keep its last mix shares."""
+    shares = {}
+    mix = {}
+    i = 0
+    for year, entry in _years(processes):
+        while i < len(DECADES) and year >= DECADES[i] + 10:
+            for p, s in shares.items():
+                mix.setdefault(p, [0] * len(DECADES))[i] = s
+            i += 1
+        shares.update((k, v) for k, v in entry.items() if k != 'year')
+    for i in range(i, len(DECADES)):
+        for p, s in shares.items():
+            mix.setdefault(p, [0] * len(DECADES))[i] = s
+    return mix
+
+def completion_years(projects):
+    """`{project: year first completed}` from a `project_timeline`."""
+    years = {}
+    for year, entry in _years(projects):
+        for k, v in entry.items():
+            if k != 'year' and v[0] in COMPLETED:
+                years.setdefault(k, year)
+    return years
+
+def features(processes, projects, vocab):
+    """Feature vector of a session from its `process_timeline` and `project_timeline`.
+    `vocab` is `(process ids, project ids)`; others are left out.
+    Each part is scaled by its size so they weigh about the same in distances."""
+    process_ids, project_ids = vocab
+    mix = mix_by_decade(processes)
+    mix = np.array([mix.get(p, [0] * len(DECADES)) for p in process_ids],
+            dtype=np.float32).ravel() / MAX_MIX_SHARE
+    completed = completion_years(projects)
+    done = np.array([(END_YEAR - completed[p]) / (END_YEAR - START_YEAR) if p in completed else 0
+        for p in project_ids], dtype=np.float32).clip(0, 1)
+    return np.concatenate([
+        mix / np.sqrt(max(len(mix), 1)),
+        done / np.sqrt(max(len(done), 1)),
+    ])
+
+def fit(vectors, dims=DIMS):
+    """`(mean, components)` of a PCA projection of `vectors` to `dims` dimensions."""
+    if len(vectors) > FIT_SAMPLE:
+        rng = np.random.default_rng(0)
+        vectors = vectors[rng.choice(len(vectors), FIT_SAMPLE, replace=False)]
+    mean = vectors.mean(axis=0)
+    _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+    return mean, vt[:dims]
+
+class Index:
+    def __init__(self, sessions, counts, processes, projects, mean, components, vectors):
+        self.sessions = sessions
+        self.counts = counts
+        self.processes = processes
+        self.projects = projects
+        self.mean = mean
+        self.components = components
+        self.vectors = vectors
+        self._index = {id: i for i, id in enumerate(sessions)}
+        self._norms = (vectors ** 2).sum(axis=1)
+
+    @classmethod
+    def load(cls, db, sessions=None, cache='similar.npz', refit=False, dims=DIMS):
+        """Index `sessions` (as returned by `db.sessions()`; all sessions if `None`).
+        Sessions already in the cache are only re-read if they have new snapshots."""
+        if sessions is None:
+            sessions = db.sessions()
+        sessions = [s for s in sessions if s['n_snapshots'] > 0]
+
+        cached = None
+        if cache and os.path.exists(cache) and not refit:
+            cached = cls.from_file(cache)
+
+        if cached is None:
+            read = {s['id']: timelines(db, s['id']) for s in sessions}
+            processes, projects = set(), set()
+            for process_tl, project_tl in read.values():
+                processes.update(mix_by_decade(process_tl))
+                projects.update(k for entry in project_tl for k in entry if k != 'year')
+            vocab = sorted(processes), sorted(projects)
+            full = np.array([features(*read[s['id']], vocab) for s in sessions], dtype=np.float32)
+            full = full.reshape(len(sessions), -1)
+            mean, components = fit(full, dims) if len(full) else (full.mean(axis=0), full[:0])
+            vectors = (full - mean) @ components.T
+        else:
+            vocab = cached.processes, cached.projects
+            mean, components = cached.mean, cached.components
+            vectors = np.zeros((len(sessions), len(components)), dtype=np.float32)
+            for i, s in enumerate(sessions):
+                j = cached._index.get(s['id'])
+                if j is not None and cached.counts[j] == s['n_snapshots']:
+                    vectors[i] = cached.vectors[j]
+                else:
+                    vectors[i] = cached.vector(*timelines(db, s['id']))
+
+        index = cls(
+            sessions=[s['id'] for s in sessions],
+            counts=[s['n_snapshots'] for s in sessions],
+            processes=vocab[0], projects=vocab[1],
+            mean=mean, components=components,
+            vectors=vectors.astype(np.float32))
+        if cache:
+            index.save(cache)
+        return index
+
+    @classmethod
+    def from_file(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            meta = json.loads(str(f['meta']))
+            return cls(
+                sessions=meta['sessions'],
+                counts=meta['counts'],
+                processes=meta['processes'],
+                projects=meta['projects'],
+                mean=f['mean'],
+                components=f['components'],
+                vectors=f['vectors'])
+
+    def save(self, path):
+        meta = {
+            'sessions': self.sessions,
+            'counts': self.counts,
+            'processes': self.processes,
+            'projects': self.projects,
+        }
+        # `np.savez` adds `.npz` if it's not there
+        with open(path, 'wb') as f:
+            np.savez_compressed(f,
+                    meta=json.dumps(meta),
+                    mean=self.mean,
+                    components=self.components,
+                    vectors=self.vectors)
+
+    def __contains__(self, session_id):
+        return session_id in self._index
+
+    def vector(self, processes, projects):
+        """The projected vector of a session from its timelines,
+        e.g. for one that isn't in the index."""
+        full = features(processes, projects, (self.processes, self.projects))
+        return (full - self.mean) @ self.components.T
+
+    def query(self, vector, k=10, exclude=None):
+        """The `k` sessions nearest to `vector`, nearest first,
+        as `[(session_id, distance)]`. `exclude` is a session index to leave out."""
+        # |a - b|^2 = |a|^2 - 2 a.b + |b|^2, the last being the same for all
+        dists = self._norms - 2 * (self.vectors @ vector.astype(np.float32))
+        if exclude is not None:
+            dists[exclude] = np.inf
+        k = min(k, len(dists) - (exclude is not None))
+        if k <= 0:
+            return []
+        nearest = np.argpartition(dists, k - 1)[:k]
+        nearest = nearest[np.argsort(dists[nearest])]
+        base = float(vector @ vector)
+        return [(self.sessions[i], float(np.sqrt(max(dists[i] + base, 0)))) for i in nearest]
+
+    def similar(self, session_id, k=10):
+        """The `k` sessions most like an indexed one (leaving it out)."""
+        i = self._index.get(session_id)
+        if i is None:
+            raise KeyError('Session {} isn\'t in the index'.format(session_id))
+        return self.query(self.vectors[i], k, exclude=i)
+
+@click.group()
+def main():
+    pass
+
+@main.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--cache', default='similar.npz', help='Where to keep the index')
+@click.option('--refit', is_flag=True, help='Refit the projection on all sessions')
+def build(path, cache, refit):
+    """Build or update the index."""
+    start = time.time()
+    index = Index.load(open_database(path), cache=cache, refit=refit)
+    print('Indexed {} sessions ({} processes, {} projects) in {:.1f}s'.format(
+        len(index.sessions), len(index.processes), len(index.projects), time.time() - start))
+
+@main.command()
+@click.option('--db', 'path', default='logs.db', help='Path to the database or partitions directory')
+@click.option('--cache', default='similar.npz', help='Where the index is kept')
+@click.option('--id', 'session_id', required=True, help='Session to find similar ones to')
+@click.option('-k', default=10, help='Number of sessions')
+def query(path, cache, session_id, k):
+    """List the sessions most similar to one."""
+    if os.path.exists(cache):
+        index = Index.from_file(cache)
+    else:
+        index = Index.load(open_database(path), cache=cache)
+    if session_id in index:
+        results = index.similar(session_id, k)
+    else:
+        # Not indexed (yet), so read it
+        results = index.query(index.vector(*timelines(open_database(path), session_id)), k)
+    for id, dist in results:
+        print('{}  {:.3f}'.format(id, dist))
+
+if __name__ == '__main__':
+    main()
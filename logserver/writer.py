@@ -0,0 +1,131 @@
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+import metrics
+from db import now
+from server import batches
+
+logger = logging.getLogger(__name__)
+
+class QueueFull(Exception):
+    pass
+
+def write_batch(db, con, batch):
+    """Write a batch of queued `(kind, row)` items in one transaction.
+    Uploaded snapshot batches (`('batch', (rows, future))` items) are written
+    in their own transactions and their results set on their futures."""
+    uploads = [row for kind, row in batch if kind == 'batch']
+    batch = [item for item in batch if item[0] != 'batch']
+    try:
+        _write(db, con, batch)
+    except Exception:
+        # Fall back to writing items one at a time
+        # so that one bad row doesn't lose the whole batch
+        # (or stop the writer)
+        for item in batch:
+            try:
+                _write(db, con, [item])
+            except Exception:
+                logger.exception('Failed to write {}'.format(item[0]))
+                metrics.WRITE_ERRORS.inc(item[0])
+
+    for rows, future in uploads:
+        try:
+            future.set_result(db.write_snapshot_batch(con, rows))
+        except Exception as e:
+            metrics.WRITE_ERRORS.inc('batch')
+            future.set_exception(e)
+
+def _write(db, con, batch):
+    sessions = [row for kind, row in batch if kind == 'session']
+    snapshots = [row for kind, row in batch if kind == 'snapshot']
+    db.write(con, sessions, snapshots)
+
+class Writer:
+    """Write-behind ingestion.
+
+    Requests only enqueue their rows; a single background thread
+    owns one long-lived (WAL) connection and writes the queued rows
+    in one transaction per batch. A batch is flushed once it has
+    `batch_size` rows or once `flush_interval` seconds have passed
+    since its first row, whichever comes first.
+
+    The queue is bounded by `max_queue`. When it's full, `add_*`
+    waits up to `put_timeout` seconds and then raises `QueueFull`
+    so the caller can tell the client to back off."""
+
+    _STOP = object()
+
+    def __init__(self, db, max_queue=10000, batch_size=500,
+            flush_interval=1., put_timeout=0.5):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_session(self, session_id, version, user_agent):
+        self._put(('session', (now(), session_id, version, user_agent)))
+
+    def add_snapshot(self, session_id, snapshot, weight=1):
+        self._put(('snapshot', (now(), session_id, snapshot, weight)))
+
+    def add_snapshots(self, rows):
+        """Insert a batch of `(session_id, snapshot, weight)` rows in one transaction
+        and wait for it to be written. Returns whether each row was inserted."""
+        timestamp = now()
+        future = Future()
+        self._put(('batch', ([(timestamp, session_id, snapshot, weight)
+            for session_id, snapshot, weight in rows], future)))
+        return future.result()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _put(self, item):
+        if self._closed:
+            raise QueueFull('Writer is closed')
+        if not self.thread.is_alive():
+            # Nothing would ever write it
+            raise QueueFull('Writer has stopped')
+        try:
+            self.queue.put(item, timeout=self.put_timeout)
+        except queue.Full:
+            raise QueueFull('Write queue is full ({} items)'.format(self.queue.maxsize))
+
+    def close(self):
+        """Stop accepting writes, flush everything
+        that's queued, and wait for the writer to finish."""
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+    def _run(self):
+        con = self.db.writer_con()
+        steps = batches(self.batch_size, self.flush_interval, self._STOP)
+        step = next(steps)
+        while True:
+            item = None
+            if isinstance(step, list):
+                try:
+                    write_batch(self.db, con, step)
+                except Exception:
+                    # `write_batch` handles bad rows itself, so this is a bug,
+                    # but keep writing the rest
+                    logger.exception('Failed to write batch')
+            else:
+                try:
+                    item = self.queue.get(timeout=step)
+                except queue.Empty:
+                    pass
+            try:
+                step = steps.send(item)
+            except StopIteration:
+                break
+        con.close()